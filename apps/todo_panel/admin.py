@@ -7,3 +7,9 @@ class MicrosoftUserAdmin(admin.ModelAdmin):
     readonly_fields = ('client_id_hash', 'created_at', 'last_login')
     search_fields = ('client_id_hash',)
     ordering = ('-last_login',)
+    list_per_page = 50
+    show_full_result_count = False  # Evita un COUNT(*) extra en tablas grandes
+
+    def get_queryset(self, request):
+        # El listado solo muestra metadatos: no traer los tokens encriptados
+        return super().get_queryset(request).only('client_id_hash', 'last_login', 'created_at')
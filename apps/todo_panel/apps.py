@@ -1,5 +1,18 @@
+import os
+
 from django.apps import AppConfig
 
 class TodoPanelConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.todo_panel'
+
+    def ready(self):
+        # Las sesiones HTTP viven lo que el worker (conexiones a Graph y a
+        # login.microsoftonline.com siempre calientes). Si gunicorn hace fork
+        # después de cargar la app (--preload), cada hijo arma las suyas en
+        # lugar de compartir sockets con el padre.
+        if hasattr(os, 'register_at_fork'):
+            from .services import export_service, microsoft_auth, microsoft_client
+            os.register_at_fork(after_in_child=microsoft_client.reset_session_after_fork)
+            os.register_at_fork(after_in_child=microsoft_auth.reset_session_after_fork)
+            os.register_at_fork(after_in_child=export_service.reset_export_slots_after_fork)
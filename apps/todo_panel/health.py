@@ -4,15 +4,46 @@ from django.db.utils import OperationalError
 from django.core.cache import caches
 from django.views.decorators.http import require_http_methods
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Los probes de Kubernetes llegan cada pocos segundos por pod: reutilizamos
+# el último resultado durante una ventana corta para no multiplicar las
+# consultas a DB y Redis, sin ocultar una caída real por más de 1s.
+HEALTH_CACHE_TTL = 1.0
+
+_health_lock = threading.Lock()
+_last_health = None  # (timestamp monotónico, payload, status_code)
+
+
 @require_http_methods(["GET"])
 def health_check(request):
     """
     Endpoint para verificar el estado de salud de la aplicación.
     Verifica conectividad a Base de Datos y Redis.
+    
+    El resultado se memoiza HEALTH_CACHE_TTL segundos y solo un hilo a la
+    vez ejecuta las verificaciones; los demás esperan y reutilizan su resultado.
     """
+    global _last_health
+
+    cached = _last_health
+    if cached and time.monotonic() - cached[0] < HEALTH_CACHE_TTL:
+        return JsonResponse(cached[1], status=cached[2])
+
+    with _health_lock:
+        cached = _last_health
+        if not cached or time.monotonic() - cached[0] >= HEALTH_CACHE_TTL:
+            health_status, status_code = _run_checks()
+            cached = _last_health = (time.monotonic(), health_status, status_code)
+
+    return JsonResponse(cached[1], status=cached[2])
+
+
+def _run_checks():
+    """Ejecuta las verificaciones de DB y caché. Retorna (payload, status_code)."""
     health_status = {
         "status": "healthy",
         "checks": {
@@ -33,14 +64,13 @@ def health_check(request):
         status_code = 503
         logger.error(f"Health check failed: Database error: {e}")
 
-    # Verificar Cache (Redis)
+    # Verificar Cache (Redis) con un solo PING en lugar de set + get
     try:
         cache = caches['default']
-        cache.set('health_check', 'ok', timeout=1)
-        if cache.get('health_check') == 'ok':
+        if cache.client.get_client().ping():
             health_status["checks"]["cache"] = "ok"
         else:
-            health_status["checks"]["cache"] = "error: read/write failed"
+            health_status["checks"]["cache"] = "error: ping failed"
             health_status["status"] = "unhealthy"
             status_code = 503
     except Exception as e:
@@ -49,4 +79,4 @@ def health_check(request):
         status_code = 503
         logger.error(f"Health check failed: Cache error: {e}")
 
-    return JsonResponse(health_status, status=status_code)
+    return health_status, status_code
@@ -4,8 +4,10 @@ Comando de Django para monitorear el estado de Redis.
 Uso:
     python manage.py monitor_redis
     python manage.py monitor_redis --continuous  # Monitoreo continuo cada 30s
+    python manage.py monitor_redis --events      # Reacciona a evictions (keyspace notifications)
 """
 
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from apps.todo_panel.services.cache_optimizer import CacheMetrics
 import time
@@ -27,15 +29,23 @@ class Command(BaseCommand):
             default=30,
             help='Intervalo en segundos para monitoreo continuo (default: 30)',
         )
+        parser.add_argument(
+            '--events',
+            action='store_true',
+            help='Espera eventos de eviction vía keyspace notifications en lugar de sondear INFO',
+        )
 
     def handle(self, *args, **options):
         continuous = options['continuous']
         interval = options['interval']
+        events = options['events']
 
         self.stdout.write(self.style.SUCCESS('=== Redis Monitoring ===\n'))
 
         try:
-            if continuous:
+            if events:
+                self._watch_evictions(interval)
+            elif continuous:
                 self.stdout.write(f'Monitoreo continuo activado (intervalo: {interval}s)')
                 self.stdout.write('Presiona Ctrl+C para detener\n')
                 
@@ -49,6 +59,60 @@ class Command(BaseCommand):
             self.stdout.write(self.style.WARNING('\nMonitoreo detenido por el usuario'))
             sys.exit(0)
 
+    def _watch_evictions(self, interval):
+        """
+        Bloquea esperando eventos 'evicted' de Redis en lugar de sondear INFO.
+        
+        Sin actividad no se ejecuta ningún comando contra Redis; ante una
+        eviction se muestra el snapshot de métricas inmediatamente.
+        
+        notify-keyspace-events es global del servidor: se agregan solo los
+        flags que faltan y al salir se restaura el valor original.
+        """
+        redis_client = cache.client.get_client()
+        try:
+            original = redis_client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+            if isinstance(original, bytes):
+                original = original.decode()
+            # E: eventos keyevent, e: evictions ('A' ya incluye 'e')
+            missing = ''.join(
+                flag for flag in 'Ee'
+                if flag not in original and not (flag == 'e' and 'A' in original)
+            )
+            if missing:
+                redis_client.config_set('notify-keyspace-events', original + missing)
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'No se pudo habilitar keyspace notifications: {e}'))
+            return
+
+        db = redis_client.connection_pool.connection_kwargs.get('db', 0)
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(f'__keyevent@{db}__:evicted')
+
+        self.stdout.write(f'Escuchando evictions en la DB {db}')
+        self.stdout.write('Presiona Ctrl+C para detener\n')
+        self._display_metrics()
+
+        try:
+            while True:
+                message = pubsub.get_message(timeout=interval)
+                if message is None:
+                    continue
+
+                # Drenar la ráfaga de eventos antes de consultar INFO una sola vez
+                evicted = 1
+                while pubsub.get_message(timeout=0.1) is not None:
+                    evicted += 1
+                self.stdout.write(self.style.WARNING(f'\n⚠️  {evicted} claves evictadas'))
+                self._display_metrics()
+        finally:
+            pubsub.close()
+            if missing:
+                try:
+                    redis_client.config_set('notify-keyspace-events', original)
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f'No se pudo restaurar notify-keyspace-events: {e}'))
+
     def _display_metrics(self):
         """Muestra las métricas de Redis en formato legible."""
         metrics = CacheMetrics.log_stats()
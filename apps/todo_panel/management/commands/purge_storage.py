@@ -0,0 +1,39 @@
+"""
+Comando de Django para borrar del storage los archivos temporales vencidos.
+
+Los adjuntos descargados de Microsoft To Do y los ZIP de exportaciones en
+segundo plano se guardan en default_storage, y Redis solo conserva una
+referencia con TTL: los archivos no expiran solos. La app ya purga al guardar
+adjuntos y al exportar; este comando sirve para correrlo por cron (o a mano)
+aunque nadie esté usando la app.
+
+Uso:
+    python manage.py purge_storage
+    python manage.py purge_storage --max-age 600  # Adjuntos con más de 10 minutos
+"""
+
+from django.core.management.base import BaseCommand
+from apps.todo_panel.services.attachment_storage import (
+    ATTACHMENT_RETENTION, purge_attachments, purge_directory
+)
+from apps.todo_panel.services.export_service import ExportService
+
+
+class Command(BaseCommand):
+    help = 'Borra del storage los adjuntos y exportaciones vencidos'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age',
+            type=int,
+            default=ATTACHMENT_RETENTION,
+            help=f'Antigüedad máxima de los adjuntos en segundos (default: {ATTACHMENT_RETENTION})',
+        )
+
+    def handle(self, *args, **options):
+        deleted = purge_attachments(options['max_age'])
+        self.stdout.write(self.style.SUCCESS(f'Adjuntos borrados: {deleted}'))
+        
+        # Los ZIP no descargados viven lo mismo que el estado de su exportación
+        deleted = purge_directory(ExportService.EXPORT_DIR, ExportService.EXPORT_STATUS_TTL)
+        self.stdout.write(self.style.SUCCESS(f'Exportaciones borradas: {deleted}'))
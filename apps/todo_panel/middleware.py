@@ -1,9 +1,31 @@
 import time
 import logging
-import json
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+# Rutas de alto tráfico sin valor de auditoría (probes de liveness/readiness)
+SKIP_LOGGING_PATHS = frozenset({'/health/'})
+
+def get_client_ip(request):
+    """
+    Retorna la IP del cliente (primer salto de X-Forwarded-For o REMOTE_ADDR).
+    
+    Se calcula una sola vez por request y queda en request._client_ip para
+    cualquier otro consumidor.
+    """
+    ip = getattr(request, '_client_ip', None)
+    if ip is None:
+        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+        if x_forwarded_for:
+            # partition no construye una lista con todos los saltos
+            ip = x_forwarded_for.partition(',')[0].strip()
+        else:
+            ip = request.META.get('REMOTE_ADDR')
+        request._client_ip = ip
+    return ip
+
+
 class RequestLoggingMiddleware:
     """
     Middleware para loguear detalles de cada request.
@@ -12,39 +34,60 @@ class RequestLoggingMiddleware:
         self.get_response = get_response
 
     def __call__(self, request):
-        start_time = time.time()
+        if request.path in SKIP_LOGGING_PATHS:
+            return self.get_response(request)
+
+        start_time = time.perf_counter()
         
         # Procesar request
         response = self.get_response(request)
         
         # Calcular duración
-        duration = (time.time() - start_time) * 1000
+        duration = (time.perf_counter() - start_time) * 1000
+
+        if response.status_code >= 500:
+            level, outcome = logging.ERROR, 'failed'
+        elif response.status_code >= 400:
+            level, outcome = logging.WARNING, 'warning'
+        else:
+            level, outcome = logging.INFO, 'success'
+
+        # Si el nivel está filtrado no hay nada que armar
+        if not logger.isEnabledFor(level):
+            return response
         
         # Obtener IP del cliente
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
+        ip = get_client_ip(request)
             
         # Obtener User ID si existe
-        user_id = request.session.get('user_id', 'anonymous')
+        request._cached_user_id = self._get_user_id(request)
         
-        # Loguear detalles
+        # Loguear detalles (el formateo lo hace el handler, y solo si emite el registro)
         log_data = {
             'method': request.method,
             'path': request.path,
             'status': response.status_code,
             'duration_ms': round(duration, 2),
             'ip': ip,
-            'user_id': user_id
+            'user_id': request._cached_user_id
         }
-        
-        if response.status_code >= 500:
-            logger.error(f"Request failed: {json.dumps(log_data)}")
-        elif response.status_code >= 400:
-            logger.warning(f"Request warning: {json.dumps(log_data)}")
-        else:
-            logger.info(f"Request success: {json.dumps(log_data)}")
+        logger.log(
+            level,
+            "Request %s: %s %s %s %.2fms ip=%s user_id=%s",
+            outcome, request.method, request.path, response.status_code,
+            duration, ip, request._cached_user_id,
+            extra=log_data,
+        )
             
         return response
+
+    @staticmethod
+    def _get_user_id(request):
+        """
+        Lee el user_id de la sesión sin despertar el backend de sesiones
+        si el request no trajo cookie y la vista tampoco tocó la sesión.
+        """
+        session = request.session
+        if settings.SESSION_COOKIE_NAME in request.COOKIES or session.accessed:
+            return session.get('user_id', 'anonymous')
+        return 'anonymous'
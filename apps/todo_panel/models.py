@@ -1,5 +1,26 @@
 from django.db import models
 
+
+class MicrosoftUserManager(models.Manager):
+    """
+    Consultas de MicrosoftUser para el camino caliente de cada request.
+    
+    Los tokens son BinaryField relativamente grandes; cada vista solo necesita
+    el access token (para MicrosoftClient). El client_id y el refresh token se
+    cargan diferidos únicamente si hay que renovar (401).
+    """
+    REQUEST_FIELDS = ('id', 'client_id_hash', 'encrypted_access_token')
+    REFRESH_FIELDS = ('encrypted_client_id', 'encrypted_refresh_token')
+
+    def for_request(self, user_id):
+        """Usuario con solo los campos que usa MicrosoftClient en una request."""
+        return self.only(*self.REQUEST_FIELDS).get(id=user_id)
+
+    def for_refresh(self, user_id):
+        """Igual que for_request pero incluye lo necesario para renovar (syncs largos)."""
+        return self.only(*self.REQUEST_FIELDS, *self.REFRESH_FIELDS).get(id=user_id)
+
+
 class MicrosoftUser(models.Model):
     """
     Modelo para almacenar usuarios autenticados con Microsoft.
@@ -8,9 +29,10 @@ class MicrosoftUser(models.Model):
     No almacena información personal identificable (PII) en texto plano.
     """
     # Hash SHA-256 del Client ID para búsquedas rápidas y anónimas
-    client_id_hash = models.CharField(max_length=64, unique=True, db_index=True)
+    # unique=True ya crea el índice único (db_index=True era redundante)
+    client_id_hash = models.CharField(max_length=64, unique=True)
     
-    # Datos sensibles encriptados (Fernet)
+    # Datos sensibles encriptados (AES-GCM raw; filas antiguas en Fernet)
     encrypted_client_id = models.BinaryField()
     encrypted_access_token = models.BinaryField()
     encrypted_refresh_token = models.BinaryField(null=True, blank=True)
@@ -19,10 +41,13 @@ class MicrosoftUser(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     last_login = models.DateTimeField(auto_now=True)
     
+    objects = MicrosoftUserManager()
+    
     class Meta:
         verbose_name = "Microsoft User"
         verbose_name_plural = "Microsoft Users"
         indexes = [
+            # Usado por el admin (ordering = -last_login, paginado de a 50)
             models.Index(fields=['last_login']),
         ]
 
@@ -0,0 +1,161 @@
+"""
+Almacenamiento de adjuntos descargados de Microsoft To Do.
+
+El contenido se escribe una sola vez en default_storage (disco, S3, MinIO...)
+y en la caché solo se guarda una referencia chica {'path', 'size'} con TTL.
+Así Redis no transporta megabytes por adjunto en cada lectura y el tamaño se
+conoce sin tocar el archivo (validación de exportaciones).
+
+Redis olvida la referencia solo, pero el archivo no: purge_attachments() borra
+los que superan ATTACHMENT_RETENTION. Corre en segundo plano como mucho una vez
+cada ATTACHMENT_PURGE_INTERVAL al guardar adjuntos, y también a mano o por cron
+con `python manage.py purge_storage`.
+"""
+
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Union
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_KEY_PREFIX = "microsoft_attachment:"
+ATTACHMENT_DIR = "attachments/"
+ATTACHMENT_TTL = 300  # 5 minutos, igual que el cacheo previo del contenido
+ATTACHMENT_RETENTION = 3600  # Vida máxima del archivo desde que se escribió
+ATTACHMENT_PURGE_INTERVAL = 600
+_PURGE_LOCK_KEY = "attachment_purge_lock"
+
+
+def attachment_cache_key(list_id: str, task_id: str, attachment_id: str) -> str:
+    return f"{ATTACHMENT_KEY_PREFIX}{list_id}:{task_id}:{attachment_id}"
+
+
+def _storage_path(cache_key: str) -> str:
+    # Los IDs de Graph traen caracteres poco amigables para nombres de archivo
+    return f"{ATTACHMENT_DIR}{hashlib.sha256(cache_key.encode()).hexdigest()}.bin"
+
+
+def store_attachment(cache_key: str, content: Union[bytes, File]) -> Dict:
+    """
+    Guarda el contenido en el storage y cachea su referencia.
+
+    La ruta es determinística por cache_key: una copia anterior se reemplaza
+    (en vez de dejar huérfana otra con sufijo) y el archivo queda con fecha
+    nueva para la retención.
+    """
+    path = _storage_path(cache_key)
+    if default_storage.exists(path):
+        default_storage.delete(path)
+    file = ContentFile(content) if isinstance(content, bytes) else content
+    path = default_storage.save(path, file)
+
+    ref = {'path': path, 'size': default_storage.size(path)}
+    cache.set(cache_key, ref, timeout=ATTACHMENT_TTL)
+    _schedule_purge()
+    return ref
+
+
+def _valid_ref(ref) -> bool:
+    # Solo referencias creadas por store_attachment (la clave viene de la URL)
+    return isinstance(ref, dict) and str(ref.get('path', '')).startswith(ATTACHMENT_DIR)
+
+
+def get_attachment_ref(cache_key: str) -> Optional[Dict]:
+    if not cache_key.startswith(ATTACHMENT_KEY_PREFIX):
+        return None
+    ref = cache.get(cache_key)
+    return ref if _valid_ref(ref) else None
+
+
+def get_attachment_refs(cache_keys: Iterable[str]) -> Dict[str, Dict]:
+    """Referencias de varios adjuntos en un solo MGET (las ausentes no se incluyen)."""
+    keys: List[str] = [key for key in cache_keys if key.startswith(ATTACHMENT_KEY_PREFIX)]
+    if not keys:
+        return {}
+    return {key: ref for key, ref in cache.get_many(keys).items() if _valid_ref(ref)}
+
+
+def read_attachment(ref: Dict) -> Optional[bytes]:
+    """Lee el contenido referenciado; None si el archivo ya no existe."""
+    try:
+        with default_storage.open(ref['path'], 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        logger.warning(f"Adjunto referenciado pero ausente en storage: {ref['path']}")
+        return None
+
+
+def load_attachment(cache_key: str) -> Optional[bytes]:
+    """Contenido del adjunto si su referencia sigue en caché."""
+    ref = get_attachment_ref(cache_key)
+    return read_attachment(ref) if ref else None
+
+
+def touch_attachment(cache_key: str) -> None:
+    """Extiende el TTL de la referencia sin reescribirla."""
+    cache.touch(cache_key, timeout=ATTACHMENT_TTL)
+
+
+def attachment_file_exists(ref: Dict) -> bool:
+    """La referencia puede sobrevivir al archivo si la purga ya lo borró."""
+    return default_storage.exists(ref['path'])
+
+
+def purge_directory(directory: str, max_age: int) -> int:
+    """
+    Borra los archivos de directory (sin recursión) escritos hace más de
+    max_age segundos. También la usa la exportación en segundo plano.
+
+    Returns:
+        Cantidad de archivos borrados
+    """
+    try:
+        _, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return 0
+
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    deleted = 0
+    for name in files:
+        path = f"{directory}{name}"
+        try:
+            if default_storage.get_modified_time(path) < cutoff:
+                default_storage.delete(path)
+                deleted += 1
+        except FileNotFoundError:
+            continue  # Otro worker lo borró entre listdir y el borrado
+
+    if deleted:
+        logger.info(f"Purgados {deleted} archivos de {directory} con más de {max_age}s")
+    return deleted
+
+
+def purge_attachments(max_age: int = ATTACHMENT_RETENTION) -> int:
+    """
+    Borra los adjuntos escritos hace más de max_age segundos.
+
+    Una referencia que siga viva tras la purga solo provoca una nueva
+    descarga (save_attachment verifica que el archivo exista).
+    """
+    return purge_directory(ATTACHMENT_DIR, max_age)
+
+
+def _schedule_purge() -> None:
+    """Dispara la purga en segundo plano, como mucho una vez por intervalo entre todos los workers."""
+    if not cache.add(_PURGE_LOCK_KEY, 1, timeout=ATTACHMENT_PURGE_INTERVAL):
+        return
+
+    def run():
+        try:
+            purge_attachments()
+        except Exception as e:
+            logger.warning(f"Error purgando adjuntos: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
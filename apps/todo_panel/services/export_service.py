@@ -17,26 +17,98 @@ Referencias OWASP:
 
 import zipfile
 import io
-import json
 import logging
 import re
 import os
-from typing import Dict, List, Tuple, Optional
-from datetime import datetime, timedelta
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Iterator, List, Tuple, Optional
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from urllib.parse import quote
+from zoneinfo import ZoneInfo
 
-import pandas as pd
+import orjson
 from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
 from django.conf import settings
 
+from .attachment_storage import (
+    attachment_cache_key, get_attachment_refs, load_attachment, purge_directory, read_attachment
+)
+
 logger = logging.getLogger(__name__)
 
+# Zona horaria de presentación de fechas en las exportaciones
+_TZ_LOCAL = ZoneInfo('America/Argentina/Buenos_Aires')
+
+# Patrones precompilados (sanitize_filename y formateo de links en Markdown)
+_RE_FILENAME_INVALID = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+_RE_LINK_WITH_TEXT = re.compile(r'([^\s<]+)<((?:http|https)://[^>]+)>')
+_RE_LINK_BARE = re.compile(r'<((?:http|https)://[^>]+)>')
+
+# Nombres reservados de Windows
+_RESERVED_FILENAMES = frozenset({
+    'CON', 'PRN', 'AUX', 'NUL', 'COM1', 'COM2', 'COM3', 'COM4',
+    'COM5', 'COM6', 'COM7', 'COM8', 'COM9', 'LPT1', 'LPT2',
+    'LPT3', 'LPT4', 'LPT5', 'LPT6', 'LPT7', 'LPT8', 'LPT9',
+})
+
+# Textos del Markdown por importancia/estado (el resto usa el valor por defecto)
+_MD_IMPORTANCE_ICONS = {'high': '🔴'}
+_MD_STATUS_TEXT = {'completed': 'Completada'}
+
+# Extensiones que el Markdown muestra embebidas como imagen
+_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+# Firmas (magic bytes) de formatos ya comprimidos: deflate no ahorra bytes,
+# solo gasta CPU, así que se guardan con ZIP_STORED
+_INCOMPRESSIBLE_SIGNATURES = (
+    b'\x89PNG',          # PNG
+    b'\xff\xd8\xff',     # JPEG
+    b'GIF8',             # GIF
+    b'RIFF',             # WEBP / AVI / WAV
+    b'PK\x03\x04',       # ZIP, DOCX, XLSX, PPTX
+    b'%PDF',             # PDF (streams internos comprimidos)
+    b'\x1f\x8b',         # GZIP
+    b'7z\xbc\xaf',       # 7-Zip
+)
+
 
 class ExportLimitExceeded(Exception):
     """Excepción cuando se exceden los límites de exportación."""
     pass
 
 
+class _ZipStreamBuffer(io.RawIOBase):
+    """
+    Destino de escritura no seekable para zipfile que acumula los bytes escritos
+    hasta que el generador los drena. Permite emitir el ZIP por partes en lugar
+    de construirlo entero en memoria (zipfile usa data descriptors al no poder
+    hacer seek).
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+    
+    def drain(self) -> bytes:
+        """Retorna y descarta todo lo escrito desde el último drain."""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
 class ExportService:
     """
     Servicio centralizado para exportación de tareas con controles de seguridad.
@@ -53,36 +125,84 @@ class ExportService:
     MAX_TASKS_PER_EXPORT = getattr(settings, 'MAX_TASKS_PER_EXPORT', 500)
     MAX_ATTACHMENT_SIZE = getattr(settings, 'MAX_ATTACHMENT_SIZE', 10 * 1024 * 1024)  # 10MB
     MAX_TOTAL_EXPORT_SIZE = getattr(settings, 'MAX_TOTAL_EXPORT_SIZE', 50 * 1024 * 1024)  # 50MB
+    ATTACHMENT_PREFETCH_BATCH = 50  # Claves de adjuntos por MGET (acota memoria en streaming)
+    ZIP_WRITE_CHUNK_SIZE = 64 * 1024  # Bloque de escritura por entrada del ZIP
+    # Exportación en background: el estado vive EXPORT_STATUS_TTL en caché y el
+    # ZIP se borra al descargarlo; los nunca descargados los purga _purge_exports
+    # pasado el mismo plazo
+    EXPORT_STATUS_TTL = 3600
+    EXPORT_DIR = "exports/"
+    EXPORT_MAX_RUNTIME = 900  # Un 'running' más viejo que esto murió con su worker
+    EXPORT_PURGE_INTERVAL = 600
+    EXPORT_SPOOL_MAX_SIZE = 8 * 1024 * 1024  # Hasta 8MB en memoria, luego a disco
+    # Hilos de exportación simultáneos por proceso: el rate limit es por usuario
+    # y no acota cuántos hilos (memoria, conexiones a Graph) corren a la vez
+    EXPORT_MAX_CONCURRENT = getattr(settings, 'EXPORT_MAX_CONCURRENT', 4)
+    _EXPORT_SLOTS = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+    # Deflate nivel 1 (~3x más rápido que el 6 por defecto) para adjuntos;
+    # el documento JSON/Markdown es chico y se comprime un poco más
+    ZIP_COMPRESSLEVEL = getattr(settings, 'EXPORT_ZIP_COMPRESSLEVEL', 1)
+    ZIP_TEXT_COMPRESSLEVEL = getattr(settings, 'EXPORT_ZIP_TEXT_COMPRESSLEVEL', 3)
+    
+    # Ventana deslizante con sorted set (score = timestamp ms), en un único
+    # round-trip atómico. Evita el doble de exportaciones en el borde de una
+    # ventana fija. Retorna {1, 0} si se permite, {0, ms_hasta_liberar_un_cupo}
+    # si no. ARGV: ahora_ms, ventana_ms, límite, id_único
+    _RATE_LIMIT_LUA = """
+    local now = tonumber(ARGV[1])
+    local window = tonumber(ARGV[2])
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+    if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+        redis.call('ZADD', KEYS[1], now, ARGV[4])
+        redis.call('PEXPIRE', KEYS[1], window)
+        return {1, 0}
+    end
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return {0, tonumber(oldest[2]) + window - now}
+    """
+    _rate_limit_script = None  # redis-py Script: EVALSHA con fallback a EVAL ante NOSCRIPT
+    RATE_LIMIT_WINDOW_MS = 3600 * 1000
     
     def __init__(self, user_id: int, client):
         self.user_id = user_id
         self.client = client
         self.total_size = 0
+        # zip_path -> (nombre, path URL-encoded, es_imagen), precalculado al agregar
+        # cada adjunto para que el Markdown no vuelva a parsear los paths
+        self._attachment_links: Dict[str, Tuple[str, str, bool]] = {}
         
     def check_rate_limit(self) -> None:
         """
-        Verifica el rate limit de exportaciones por usuario.
+        Verifica el rate limit de exportaciones por usuario (ventana deslizante de 1 hora).
         Usa Redis para tracking distribuido.
         
         Raises:
             ExportLimitExceeded: Si se excede el límite de exportaciones.
         """
-        cache_key = f"export_rate_limit:{self.user_id}"
-        current_count = cache.get(cache_key, 0)
+        cache_key = cache.make_key(f"export_rl_zset:{self.user_id}")
         
-        if current_count >= self.MAX_EXPORTS_PER_HOUR:
+        if ExportService._rate_limit_script is None:
+            ExportService._rate_limit_script = cache.client.get_client().register_script(
+                self._RATE_LIMIT_LUA
+            )
+        allowed, retry_ms = ExportService._rate_limit_script(
+            keys=[cache_key],
+            args=[int(time.time() * 1000), self.RATE_LIMIT_WINDOW_MS,
+                  self.MAX_EXPORTS_PER_HOUR, uuid.uuid4().hex],
+        )
+        
+        if not allowed:
+            retry_minutes = max(1, -(-retry_ms // 60000))  # redondeo hacia arriba
             logger.warning(
-                f"Rate limit excedido para usuario {self.user_id}. "
-                f"Intentos: {current_count}/{self.MAX_EXPORTS_PER_HOUR}"
+                f"Rate limit excedido para usuario {self.user_id}: "
+                f"{self.MAX_EXPORTS_PER_HOUR} exportaciones en la última hora"
             )
             raise ExportLimitExceeded(
                 f"Has excedido el límite de {self.MAX_EXPORTS_PER_HOUR} exportaciones por hora. "
-                "Por favor, intenta más tarde."
+                f"Por favor, intenta nuevamente en {retry_minutes} minutos."
             )
         
-        # Incrementar contador con TTL de 1 hora
-        cache.set(cache_key, current_count + 1, timeout=3600)
-        logger.info(f"Export rate limit check passed: {current_count + 1}/{self.MAX_EXPORTS_PER_HOUR}")
+        logger.info(f"Export rate limit check passed for user {self.user_id}")
     
     def validate_export_size(self, tasks: List[Dict]) -> None:
         """
@@ -100,22 +220,57 @@ class ExportService:
                 f"El límite es {self.MAX_TASKS_PER_EXPORT} por exportación."
             )
     
-    def sanitize_filename(self, filename: str) -> str:
+    def validate_attachments_size(self, list_id: str, tasks: List[Dict]) -> None:
+        """
+        Valida el tamaño total de los adjuntos antes de empezar a armar el ZIP.
+        
+        Usa el tamaño guardado en la referencia de cada adjunto (un solo MGET,
+        sin leer el contenido del storage). Los adjuntos ausentes o mayores a
+        MAX_ATTACHMENT_SIZE no cuentan: process_attachment los omite.
+        
+        Raises:
+            ExportLimitExceeded: Si el total supera MAX_TOTAL_EXPORT_SIZE.
+        """
+        refs = get_attachment_refs(
+            self._attachment_cache_key(list_id, tarea['id'], attachment['id'])
+            for tarea in tasks
+            if tarea.get('hasAttachments') and tarea.get('attachments')
+            for attachment in tarea['attachments']
+        )
+        if not refs:
+            return
+        
+        total = sum(
+            ref['size'] for ref in refs.values() if ref['size'] <= self.MAX_ATTACHMENT_SIZE
+        )
+        
+        if total > self.MAX_TOTAL_EXPORT_SIZE:
+            raise ExportLimitExceeded(
+                f"Los adjuntos de la lista suman {total // (1024 * 1024)} MB. "
+                f"El límite es {self.MAX_TOTAL_EXPORT_SIZE // (1024 * 1024)} MB por exportación."
+            )
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def sanitize_filename(filename: str) -> str:
         """
         Sanitiza nombres de archivo para prevenir path traversal.
         
+        Función pura: se memoiza para no repetir el trabajo con nombres
+        repetidos (ej: adjuntos "image.png" en muchas tareas).
+        
         OWASP: Prevención de Path Traversal (CWE-22)
         """
         # Remover caracteres peligrosos
-        filename = re.sub(r'[<>:"/\\|?*\x00-\x1f]', '', filename)
+        filename = _RE_FILENAME_INVALID.sub('', filename)
         # Limitar longitud
         filename = filename[:255]
-        # Prevenir nombres especiales de Windows
-        reserved_names = {'CON', 'PRN', 'AUX', 'NUL', 'COM1', 'COM2', 'COM3', 'COM4', 
-                         'COM5', 'COM6', 'COM7', 'COM8', 'COM9', 'LPT1', 'LPT2', 
-                         'LPT3', 'LPT4', 'LPT5', 'LPT6', 'LPT7', 'LPT8', 'LPT9'}
-        name_without_ext = filename.rsplit('.', 1)[0].upper()
-        if name_without_ext in reserved_names:
+        # Prevenir nombres especiales de Windows (todos tienen 3 o 4 caracteres:
+        # se evita armar el nombre sin extensión para el resto de los casos)
+        stem_len = filename.rfind('.')
+        if stem_len < 0:
+            stem_len = len(filename)
+        if 3 <= stem_len <= 4 and filename[:stem_len].upper() in _RESERVED_FILENAMES:
             filename = f"file_{filename}"
         
         return filename.strip() or "unnamed_file"
@@ -126,17 +281,23 @@ class ExportService:
         attachment: Dict, 
         list_id: str, 
         task_id: str,
-        counter: int
+        counter: int,
+        file_content: Optional[bytes] = None
     ) -> Optional[str]:
         """
         Procesa un adjunto individual con validaciones de seguridad.
         
+        Args:
+            file_content: Contenido ya leído (referencias precargadas en lote);
+                          si es None se resuelve la referencia de este adjunto
+        
         Returns:
             str: Ruta relativa del adjunto en el ZIP, o None si falla
         """
         try:
-            cache_key = f"microsoft_attachment:{list_id}:{task_id}:{attachment['id']}"
-            file_content = cache.get(cache_key)
+            if file_content is None:
+                cache_key = self._attachment_cache_key(list_id, task_id, attachment['id'])
+                file_content = load_attachment(cache_key)
             
             if not file_content:
                 logger.warning(f"Adjunto no encontrado en caché: {attachment.get('name')}")
@@ -164,9 +325,15 @@ class ExportService:
                 attachment.get('name', f'attachment_{counter}.bin')
             )
             
-            # Guardar en ZIP
+            # Guardar en ZIP (sin deflate si el formato ya viene comprimido)
             zip_path = f"attachments/{filename}"
-            zip_file.writestr(zip_path, file_content)
+            compress_type = (
+                zipfile.ZIP_STORED
+                if file_content[:4].startswith(_INCOMPRESSIBLE_SIGNATURES)
+                else zipfile.ZIP_DEFLATED
+            )
+            self._write_zip_entry(zip_file, zip_path, file_content, compress_type)
+            self._attachment_links[zip_path] = self._attachment_link(zip_path, filename)
             
             self.total_size += attachment_size
             logger.info(f"Adjunto agregado: {zip_path} ({attachment_size} bytes)")
@@ -177,6 +344,36 @@ class ExportService:
             logger.error(f"Error procesando adjunto {attachment.get('name')}: {e}", exc_info=True)
             return None
     
+    @staticmethod
+    def _write_zip_entry(
+        zip_file: zipfile.ZipFile, 
+        zip_path: str, 
+        content: bytes, 
+        compress_type: int
+    ) -> None:
+        """
+        Escribe una entrada del ZIP en bloques de ZIP_WRITE_CHUNK_SIZE.
+        
+        Equivalente a writestr pero recorre el contenido con memoryview (sin
+        copias intermedias) y, junto al ZIP en streaming, acota la memoria
+        transitoria por adjunto al tamaño del bloque.
+        """
+        if compress_type == zip_file.compression:
+            # Abriendo por nombre zipfile aplica el método y el compresslevel
+            # del archivo (misma fecha y permisos que writestr)
+            target = zip_path
+        else:
+            # Otro método (ZIP_STORED): el nivel de compresión no aplica
+            target = zipfile.ZipInfo(zip_path, date_time=time.localtime()[:6])
+            target.compress_type = compress_type
+            target.external_attr = 0o600 << 16  # Mismos permisos que writestr
+            target.file_size = len(content)
+        
+        view = memoryview(content)
+        with zip_file.open(target, 'w') as dst:
+            for offset in range(0, len(view), ExportService.ZIP_WRITE_CHUNK_SIZE):
+                dst.write(view[offset:offset + ExportService.ZIP_WRITE_CHUNK_SIZE])
+    
     def create_export(
         self, 
         list_id: str, 
@@ -184,7 +381,30 @@ class ExportService:
         export_format: str = 'json'
     ) -> Tuple[bytes, str]:
         """
-        Crea la exportación completa con todas las validaciones.
+        Crea la exportación completa en memoria (ver stream_export).
+        
+        Returns:
+            Tuple[bytes, str]: (contenido del ZIP, nombre del archivo)
+            
+        Raises:
+            ExportLimitExceeded: Si se exceden límites
+        """
+        chunks, zip_filename = self.stream_export(list_id, list_name, export_format)
+        return b''.join(chunks), zip_filename
+    
+    def stream_export(
+        self, 
+        list_id: str, 
+        list_name: str, 
+        export_format: str = 'json'
+    ) -> Tuple[Iterator[bytes], str]:
+        """
+        Prepara la exportación y retorna un iterador que genera el ZIP por partes.
+        
+        Las validaciones (rate limit, tareas, tamaño) se ejecutan antes de
+        retornar, así los errores siguen pudiendo responderse con su status HTTP.
+        El ZIP se emite a medida que se agregan los adjuntos: la memoria queda
+        acotada al adjunto más grande en lugar del archivo completo.
         
         Args:
             list_id: ID de la lista a exportar
@@ -192,7 +412,7 @@ class ExportService:
             export_format: 'json' o 'markdown'
             
         Returns:
-            Tuple[bytes, str]: (contenido del ZIP, nombre del archivo)
+            Tuple[Iterator[bytes], str]: (chunks del ZIP, nombre del archivo)
             
         Raises:
             ExportLimitExceeded: Si se exceden límites
@@ -200,35 +420,210 @@ class ExportService:
         # 1. Verificar rate limit
         self.check_rate_limit()
         
+        return self._prepare_export(list_id, list_name, export_format)
+    
+    def _prepare_export(
+        self, 
+        list_id: str, 
+        list_name: str, 
+        export_format: str
+    ) -> Tuple[Iterator[bytes], str]:
+        """Obtiene y valida las tareas; retorna (chunks del ZIP, nombre del archivo)."""
         # 2. Obtener tareas
         tareas = self.client.get_tasks_by_list_id(list_id, force_refresh=True)
         if not tareas:
             raise ValueError("No hay tareas para exportar")
         
-        # 3. Validar tamaño
+        # 3. Validar tamaño (cantidad de tareas y total de adjuntos)
         self.validate_export_size(tareas)
+        self.validate_attachments_size(list_id, tareas)
+        
+        # Nombre sanitizado una sola vez (archivo interno y nombre del ZIP)
+        safe_name = self.sanitize_filename(list_name)
+        extension = '.md' if export_format == 'markdown' else '.json'
+        zip_filename = f"{safe_name}_export_{extension.lstrip('.')}.zip"
+        
+        return self._iter_zip(list_id, list_name, safe_name, tareas, export_format), zip_filename
+    
+    # ------------------------------------------------------------------
+    # Exportación en segundo plano
+    # ------------------------------------------------------------------
+    
+    @staticmethod
+    def export_status_key(user_id: int, export_id: str) -> str:
+        return f"export_status:{user_id}:{export_id}"
+    
+    @classmethod
+    def get_export_status(cls, user_id: int, export_id: str) -> Optional[Dict]:
+        """
+        Estado de una exportación en segundo plano (None si no existe o expiró).
+        
+        Si el worker se reinició a mitad de camino el hilo murió sin dejar
+        estado final: pasado EXPORT_MAX_RUNTIME se informa como error.
+        """
+        status = cache.get(cls.export_status_key(user_id, export_id))
+        if (
+            status and status['state'] == 'running'
+            and time.time() - status.get('started_at', 0) > cls.EXPORT_MAX_RUNTIME
+        ):
+            return {
+                'state': 'error',
+                'message': 'La exportación se interrumpió. Por favor, intenta nuevamente.',
+            }
+        return status
+    
+    @classmethod
+    def discard_export(cls, user_id: int, export_id: str, path: str) -> None:
+        """Borra el ZIP ya descargado y su estado (la descarga es de un solo uso)."""
+        cache.delete(cls.export_status_key(user_id, export_id))
+        try:
+            default_storage.delete(path)
+        except Exception as e:
+            logger.warning(f"No se pudo borrar la exportación {export_id}: {e}")
+    
+    @classmethod
+    def _purge_exports(cls) -> None:
+        """Borra los ZIP nunca descargados, como mucho una vez por intervalo entre workers."""
+        if cache.add("export_purge_lock", 1, timeout=cls.EXPORT_PURGE_INTERVAL):
+            purge_directory(cls.EXPORT_DIR, cls.EXPORT_STATUS_TTL)
+    
+    def export_background(
+        self, 
+        list_id: str, 
+        list_name: str, 
+        export_format: str = 'json'
+    ) -> str:
+        """
+        Inicia la exportación en segundo plano y retorna su export_id.
+        
+        El rate limit se verifica antes de lanzar el hilo (la request puede
+        responder 429 de inmediato); el resto corre fuera de la request y el
+        ZIP terminado se guarda en default_storage. El estado se consulta con
+        get_export_status, igual que el progreso de sincronización.
+        
+        Usa un hilo daemon como TaskService.sync_tasks_background: el proyecto
+        no tiene cola de tareas (Celery/RQ) y una exportación dura segundos.
+        El costo es que un reinicio del worker la corta; get_export_status lo
+        detecta por antigüedad y el usuario puede reintentar.
+        
+        Raises:
+            ExportLimitExceeded: Si se excede el rate limit o ya corren
+                EXPORT_MAX_CONCURRENT exportaciones en este proceso.
+        """
+        # Tomar el cupo antes del rate limit para no gastar una exportación de la hora
+        if not self._EXPORT_SLOTS.acquire(blocking=False):
+            raise ExportLimitExceeded(
+                "Hay demasiadas exportaciones en curso. Intenta nuevamente en unos minutos."
+            )
+        
+        try:
+            self.check_rate_limit()
+            
+            export_id = uuid.uuid4().hex
+            cache.set(
+                self.export_status_key(self.user_id, export_id),
+                {'state': 'running', 'started_at': time.time()},
+                timeout=self.EXPORT_STATUS_TTL,
+            )
+            thread = threading.Thread(
+                target=self._export_process,
+                args=(export_id, list_id, list_name, export_format),
+            )
+            thread.daemon = True
+            thread.start()
+        except BaseException:
+            self._EXPORT_SLOTS.release()
+            raise
+        return export_id
+    
+    def _export_process(
+        self, 
+        export_id: str, 
+        list_id: str, 
+        list_name: str, 
+        export_format: str
+    ) -> None:
+        """Genera el ZIP en streaming hacia un archivo temporal y lo sube al storage."""
+        status_key = self.export_status_key(self.user_id, export_id)
+        
+        try:
+            self._purge_exports()
+            chunks, zip_filename = self._prepare_export(list_id, list_name, export_format)
+            
+            # SpooledTemporaryFile: en memoria si es chico, en disco si crece
+            with tempfile.SpooledTemporaryFile(max_size=self.EXPORT_SPOOL_MAX_SIZE) as tmp:
+                for chunk in chunks:
+                    tmp.write(chunk)
+                tmp.seek(0)
+                # Ruta plana (sin subdirectorios por usuario) para que la purga
+                # no deje directorios vacíos; el nombre visible va en el estado
+                storage_path = default_storage.save(f"{self.EXPORT_DIR}{export_id}.zip", File(tmp))
+            
+            cache.set(status_key, {
+                'state': 'done',
+                'path': storage_path,
+                'filename': zip_filename,
+            }, timeout=self.EXPORT_STATUS_TTL)
+            
+        except (ExportLimitExceeded, ValueError) as e:
+            logger.warning(f"Exportación {export_id} rechazada para usuario {self.user_id}: {e}")
+            cache.set(status_key, {'state': 'error', 'message': str(e)}, timeout=self.EXPORT_STATUS_TTL)
+            
+        except Exception as e:
+            logger.error(f"Error en exportación {export_id} para usuario {self.user_id}: {e}", exc_info=True)
+            cache.set(status_key, {
+                'state': 'error',
+                'message': 'Error al exportar las tareas. Por favor, intenta nuevamente.',
+            }, timeout=self.EXPORT_STATUS_TTL)
         
+        finally:
+            self._EXPORT_SLOTS.release()
+    
+    def _iter_zip(
+        self, 
+        list_id: str, 
+        list_name: str, 
+        safe_name: str, 
+        tareas: List[Dict], 
+        export_format: str
+    ) -> Iterator[bytes]:
+        """Genera el ZIP por partes, drenando el buffer después de cada tarea."""
         # 4. Crear ZIP
-        zip_buffer = io.BytesIO()
+        buffer = _ZipStreamBuffer()
         processed_tasks = []
         attachment_counter = 0
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for tarea in tareas:
-                task_data = self._process_task(tarea, zip_file, list_id, attachment_counter)
-                processed_tasks.append(task_data)
-                attachment_counter += len(task_data.get('attachment_path', []))
+        with zipfile.ZipFile(
+            buffer, 'w', zipfile.ZIP_DEFLATED,
+            compresslevel=self.ZIP_COMPRESSLEVEL, allowZip64=True
+        ) as zip_file:
+            for batch, keys in self._iter_task_batches(list_id, tareas):
+                # Un solo MGET por lote en lugar de un GET por adjunto
+                prefetched = get_attachment_refs(keys) if keys else {}
+                
+                for tarea in batch:
+                    task_data = self._process_task(
+                        tarea, zip_file, list_id, attachment_counter, prefetched
+                    )
+                    processed_tasks.append(task_data)
+                    attachment_counter += len(task_data.get('attachment_path', []))
+                    
+                    chunk = buffer.drain()
+                    if chunk:
+                        yield chunk
+                
+                del prefetched
             
             # Generar contenido
             if export_format == 'markdown':
-                content = self._generate_markdown(list_name, processed_tasks)
+                content = self._generate_markdown(list_name, processed_tasks).encode('utf-8')
                 extension = '.md'
             else:
                 content = self._generate_json(list_name, processed_tasks)
                 extension = '.json'
             
-            filename = f"{self.sanitize_filename(list_name)}{extension}"
-            zip_file.writestr(filename, content.encode('utf-8'))
+            filename = f"{safe_name}{extension}"
+            zip_file.writestr(filename, content, compresslevel=self.ZIP_TEXT_COMPRESSLEVEL)
             
             # README si no hay adjuntos
             if attachment_counter == 0:
@@ -237,52 +632,91 @@ class ExportService:
                     'No hay adjuntos en esta lista de tareas.'
                 )
         
+        # Directorio central del ZIP (escrito al cerrar)
+        yield buffer.drain()
+        
         # 5. Auditoría
         self._log_export_audit(list_name, export_format, len(tareas), attachment_counter)
+    
+    _attachment_cache_key = staticmethod(attachment_cache_key)
+    
+    @staticmethod
+    def _attachment_link(zip_path: str, filename: str) -> Tuple[str, str, bool]:
+        """
+        Datos para enlazar un adjunto desde el Markdown.
         
-        zip_buffer.seek(0)
-        zip_filename = f"{self.sanitize_filename(list_name)}_export_{extension.lstrip('.')}.zip"
-        
-        return zip_buffer.getvalue(), zip_filename
+        El path se URL-encodea (quote con safe='/' mantiene las barras) para
+        manejar espacios y caracteres especiales.
+        """
+        return filename, quote(zip_path, safe='/'), filename.lower().endswith(_IMAGE_EXTENSIONS)
+    
+    def _iter_task_batches(self, list_id: str, tareas: List[Dict]):
+        """
+        Agrupa tareas consecutivas hasta juntar ATTACHMENT_PREFETCH_BATCH claves
+        de adjuntos. Genera (tareas_del_lote, claves_de_adjuntos).
+        """
+        batch, keys = [], []
+        for tarea in tareas:
+            if tarea.get('hasAttachments') and tarea.get('attachments'):
+                keys.extend(
+                    self._attachment_cache_key(list_id, tarea['id'], attachment['id'])
+                    for attachment in tarea['attachments']
+                )
+            batch.append(tarea)
+            if len(keys) >= self.ATTACHMENT_PREFETCH_BATCH:
+                yield batch, keys
+                batch, keys = [], []
+        if batch:
+            yield batch, keys
     
     def _process_task(
         self, 
         tarea: Dict, 
         zip_file: zipfile.ZipFile, 
         list_id: str,
-        counter: int
+        counter: int,
+        prefetched: Optional[Dict[str, Dict]] = None
     ) -> Dict:
         """Procesa una tarea individual."""
+        get = tarea.get
+        
         # Formatear fechas con manejo de errores
-        fecha_limite = self._format_date(tarea.get('dueDateTime'))
-        fecha_recordatorio = self._format_date(tarea.get('reminderDateTime'))
+        fecha_limite = self._format_date(get('dueDateTime'))
+        fecha_recordatorio = self._format_date(get('reminderDateTime'))
         
         # Procesar subtareas
-        subtareas_list = []
-        if tarea.get('checklistItems'):
-            for item in tarea['checklistItems']:
-                check = "[x]" if item.get('isChecked') else "[ ]"
-                subtareas_list.append(f"{check} {item.get('displayName', '')}")
+        subtareas_list = [
+            f"{'[x]' if item.get('isChecked') else '[ ]'} {item.get('displayName', '')}"
+            for item in get('checklistItems') or ()
+        ]
         
         # Procesar adjuntos
         attachment_paths = []
-        if tarea.get('hasAttachments') and tarea.get('attachments'):
-            for attachment in tarea['attachments']:
+        attachments = get('attachments')
+        if attachments and get('hasAttachments'):
+            task_id = tarea['id']
+            for attachment in attachments:
+                file_content = None
+                if prefetched is not None:
+                    cache_key = self._attachment_cache_key(list_id, task_id, attachment['id'])
+                    ref = prefetched.get(cache_key)
+                    # b"" marca "no está en caché" para no volver a consultarla
+                    file_content = (read_attachment(ref) or b"") if ref else b""
                 zip_path = self.process_attachment(
-                    zip_file, attachment, list_id, tarea['id'], counter
+                    zip_file, attachment, list_id, task_id, counter, file_content
                 )
                 if zip_path:
                     attachment_paths.append(zip_path)
                     counter += 1
         
         return {
-            'titulo': tarea.get('title', 'Sin título'),
-            'importancia': tarea.get('importance', 'normal'),
-            'status': tarea.get('status', 'notStarted'),
+            'titulo': get('title', 'Sin título'),
+            'importancia': get('importance', 'normal'),
+            'status': get('status', 'notStarted'),
             'fecha_limite': fecha_limite,
             'fecha_recordatorio': fecha_recordatorio,
             'subtareas': subtareas_list,
-            'descripcion': tarea.get('body', {}).get('content', ''),
+            'descripcion': (get('body') or {}).get('content', ''),
             'attachment_path': attachment_paths
         }
     
@@ -296,9 +730,11 @@ class ExportService:
             return None
         
         try:
-            return pd.to_datetime(dt_str).tz_localize('UTC').tz_convert(
-                'America/Argentina/Buenos_Aires'
-            ).strftime('%Y-%m-%d %H:%M:%S')
+            # Python 3.11+: fromisoformat acepta 'Z' y los 7 decimales de Graph
+            dt = datetime.fromisoformat(dt_str)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            return dt.astimezone(_TZ_LOCAL).strftime('%Y-%m-%d %H:%M:%S')
         except Exception as e:
             logger.warning(f"Error formateando fecha: {e}")
             return None
@@ -308,101 +744,105 @@ class ExportService:
         Genera contenido Markdown formateado a partir de una lista de tareas.
         Basado en la lógica de json_to_markdown del prototipo.
         """
-        # Ordenar tareas: primero las de importancia 'high'
-        tasks.sort(key=lambda x: 0 if x.get('importancia') == 'high' else 1)
+        # Primero las de importancia 'high': partición estable en una pasada (O(n))
+        high, rest = [], []
+        for task in tasks:
+            (high if task.get('importancia') == 'high' else rest).append(task)
+        tasks = high + rest
+
+        # Acumular partes y unir al final (+= sobre str copia todo en cada paso)
+        parts: List[str] = []
+        append = parts.append
+        append(f"# Lista de Tareas: {list_name}\n\n")
+        append(f"**Total de tareas:** {len(tasks)}\n")
+        append(f"**Fecha de exportación:** {datetime.now(_TZ_LOCAL).strftime('%Y-%m-%d %H:%M')}\n\n")
+        append("---\n\n")
 
-        md_content = f"# Lista de Tareas: {list_name}\n\n"
-        md_content += f"**Total de tareas:** {len(tasks)}\n"
-        md_content += f"**Fecha de exportación:** {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M')}\n\n"
-        md_content += "---\n\n"
+        # Tablas de traducción ligadas a locales fuera del loop
+        icon_for = _MD_IMPORTANCE_ICONS.get
+        status_text_for = _MD_STATUS_TEXT.get
 
         for task in tasks:
-            # Título e Importancia
-            icon = "🔴" if task.get('importancia') == 'high' else "🔵"
-            title = task.get('titulo', 'Sin título')
-            md_content += f"## {icon} {title}\n\n"
-            
-            # Metadatos
-            status = task.get('status', 'notStarted')
-            status_text = "Completada" if status == 'completed' else "Pendiente"
-            md_content += f"- **Estado:** {status_text}\n"
+            # Título, Importancia y Estado
+            get = task.get
+            append(
+                f"## {icon_for(get('importancia'), '🔵')} {get('titulo', 'Sin título')}\n\n"
+                f"- **Estado:** {status_text_for(get('status'), 'Pendiente')}\n"
+            )
             
             if task.get('fecha_limite'):
-                md_content += f"- **📅 Vencimiento:** {task['fecha_limite']}\n"
+                append(f"- **📅 Vencimiento:** {task['fecha_limite']}\n")
             if task.get('fecha_recordatorio'):
-                md_content += f"- **⏰ Recordatorio:** {task['fecha_recordatorio']}\n"
+                append(f"- **⏰ Recordatorio:** {task['fecha_recordatorio']}\n")
             
             # Subtareas (Checklist)
             if task.get('subtareas'):
-                md_content += "\n**Subtareas:**\n"
+                append("\n**Subtareas:**\n")
                 for sub in task['subtareas']:
-                    md_content += f"- {sub}\n"
+                    append(f"- {sub}\n")
 
             # Descripción
             if task.get('descripcion'):
                 desc = task['descripcion']
                 
                 # Procesamiento línea por línea para respetar la estructura visual
-                lines = desc.split('\r\n')
                 processed_lines = []
+                add_line = processed_lines.append
                 
-                for line in lines:
+                for line in desc.split('\r\n'):
                     # 1. Detectar Headers por caracteres invisibles (patrón de Microsoft To Do)
-                    if '\u200b\u200b' in line:
-                        # Asumimos Subtítulo (H4)
-                        line = "#### " + line.replace('\u200b', '').strip()
-                    elif '\u200b' in line:
-                        # Asumimos Título (H3)
-                        line = "### " + line.replace('\u200b', '').strip()
+                    #    y limpiarlos; las líneas sin \u200b no necesitan limpieza
+                    if '\u200b' in line:
+                        if '\u200b\u200b' in line:
+                            # Asumimos Subtítulo (H4)
+                            line = "#### " + line.replace('\u200b', '').strip()
+                        else:
+                            # Asumimos Título (H3)
+                            line = "### " + line.replace('\u200b', '').strip()
                     
-                    # 2. Limpiar caracteres invisibles restantes
-                    line = line.replace('\u200b', '')
+                    # 2. Formatear links (ambos patrones requieren "<http")
+                    if '<http' in line:
+                        # Caso 1: Texto pegado al link tipo "link<http://...>" -> "[link](http://...)"
+                        line = _RE_LINK_WITH_TEXT.sub(r'[\1](\2)', line)
+                        # Caso 2: Link solo "<http://...>" -> "[http://...](http://...)"
+                        line = _RE_LINK_BARE.sub(r'[\1](\1)', line)
                     
-                    # 3. Formatear links
-                    # Caso 1: Texto pegado al link tipo "link<http://...>" -> "[link](http://...)"
-                    line = re.sub(r'([^\s<]+)<((?:http|https)://[^>]+)>', r'[\1](\2)', line)
-                    # Caso 2: Link solo "<http://...>" -> "[http://...](http://...)"
-                    line = re.sub(r'<((?:http|https)://[^>]+)>', r'[\1](\1)', line)
-                    
-                    # 4. Asegurar saltos de línea duros
-                    if line.strip():
-                        processed_lines.append(line + "  ")
-                    else:
-                        processed_lines.append("")
+                    # 3. Asegurar saltos de línea duros
+                    add_line(line + "  " if line.strip() else "")
                 
                 desc = '\n'.join(processed_lines).strip()
                 if desc:
-                    md_content += f"\n**Descripción:**\n\n{desc}\n"
+                    append(f"\n**Descripción:**\n\n{desc}\n")
 
             # Adjuntos
             if task.get('attachment_path') and task['attachment_path']:
-                md_content += "\n**📎 Adjuntos:**\n"
+                append("\n**📎 Adjuntos:**\n")
                 for path in task['attachment_path']:
-                    filename = os.path.basename(path)
-                    # URL-encode el path para manejar espacios y caracteres especiales
-                    # Usar quote con safe='/' para mantener las barras
-                    encoded_path = quote(path, safe='/')
+                    filename, encoded_path, is_image = (
+                        self._attachment_links.get(path)
+                        or self._attachment_link(path, os.path.basename(path))
+                    )
                     
-                    # Detectar si es imagen para mostrarla embebida
-                    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
+                    # Imágenes embebidas; el resto como link
+                    if is_image:
                         # Usar tag HTML para controlar el tamaño (width="400")
-                        md_content += f'<img src="{encoded_path}" width="400" alt="{filename}">\n'
+                        append(f'<img src="{encoded_path}" width="400" alt="{filename}">\n')
                     else:
                         # Usar formato Markdown con path URL-encoded
-                        md_content += f"- [{filename}]({encoded_path})\n"
+                        append(f"- [{filename}]({encoded_path})\n")
 
-            md_content += "\n---\n\n"
+            append("\n---\n\n")
         
-        return md_content
+        return ''.join(parts)
     
-    def _generate_json(self, list_name: str, tasks: List[Dict]) -> str:
-        """Genera contenido JSON."""
+    def _generate_json(self, list_name: str, tasks: List[Dict]) -> bytes:
+        """Genera contenido JSON (UTF-8, indentado) directamente en bytes."""
         export_data = {
             'list_name': list_name,
-            'exported_at': pd.Timestamp.now().isoformat(),
+            'exported_at': datetime.now(_TZ_LOCAL),  # orjson serializa datetime (RFC 3339)
             'tasks': tasks
         }
-        return json.dumps(export_data, indent=2, ensure_ascii=False)
+        return orjson.dumps(export_data, option=orjson.OPT_INDENT_2)
     
     def _log_export_audit(
         self, 
@@ -417,3 +857,11 @@ class ExportService:
             f"format={format_type}, tasks={task_count}, "
             f"attachments={attachment_count}, size={self.total_size} bytes"
         )
+
+
+def reset_export_slots_after_fork() -> None:
+    """
+    Hook para os.register_at_fork: los hilos de exportación del padre no
+    existen en el hijo, así que sus cupos tomados nunca se liberarían.
+    """
+    ExportService._EXPORT_SLOTS = threading.BoundedSemaphore(ExportService.EXPORT_MAX_CONCURRENT)
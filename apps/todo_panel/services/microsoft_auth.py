@@ -10,6 +10,7 @@ Flujo de Autenticación:
 1. get_device_code(): Solicita un código de dispositivo
 2. Usuario visita URL y ingresa código
 3. poll_for_token(): Espera a que el usuario complete la autenticación
+   (poll_token_once(): un solo intento, para polling desde el navegador)
 4. refresh_access_token(): Renueva tokens expirados
 
 Casos de Uso:
@@ -33,10 +34,18 @@ Autor: Personal Todo Agent Team
 Última modificación: 2025-11-28
 """
 
+import hashlib
+import random
+import orjson
 import requests
+import threading
 import time
 import logging
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configurar logger para este módulo
 logger = logging.getLogger(__name__)
@@ -45,6 +54,94 @@ logger = logging.getLogger(__name__)
 DEFAULT_TENANT_ID = "consumers"  # Para cuentas personales de Microsoft
 DEFAULT_SCOPES = "user.read tasks.readwrite offline_access"
 DEFAULT_POLL_INTERVAL = 5  # Segundos entre intentos de polling
+MAX_POLL_INTERVAL = 15  # Tope del intervalo adaptativo mientras la autorización está pendiente
+DEFAULT_DEVICE_CODE_EXPIRES_IN = 900  # Vida típica del device code (15 minutos)
+REQUEST_TIMEOUT = 10  # Segundos por petición al endpoint OAuth
+MAX_POLL_BACKOFF = 60  # Tope en segundos del backoff ante errores transitorios
+SLOW_DOWN_INCREMENT = 5  # RFC 8628: sumar 5s al intervalo ante 'slow_down'
+
+# Errores de polling tras los cuales se debe reintentar
+RETRYABLE_POLL_ERRORS = frozenset({
+    'authorization_pending', 'slow_down', 'temporarily_unavailable'
+})
+
+# Sesión HTTP compartida: los tres endpoints viven en login.microsoftonline.com,
+# así que reutilizar la conexión (keep-alive) evita DNS + TCP + TLS en cada
+# intento de polling y en cada renovación de token.
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    # Los reintentos ante errores de conexión y 429/5xx los resuelve urllib3
+    # (respetando Retry-After); raise_on_status=False deja ver la última respuesta.
+    # Los POST de tokens no son idempotentes: un read timeout puede llegar después
+    # de que el servidor consumió un refresh token rotativo, y repetirlo daría
+    # invalid_grant. Por eso read=0 y other=0: solo se reintenta lo que nunca
+    # llegó al servidor (connect) o lo que el servidor rechazó con 429/5xx.
+    session.mount('https://', HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=3,
+            read=0,
+            other=0,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['POST'],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        ),
+    ))
+    session.headers.update({'Accept': 'application/json'})
+    return session
+
+
+_SESSION = _build_session()
+
+
+@lru_cache(maxsize=8)
+def _devicecode_url(tenant_id: str) -> str:
+    return f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/devicecode"
+
+
+@lru_cache(maxsize=8)
+def _token_url(tenant_id: str) -> str:
+    return f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+
+
+# Cache en proceso de tokens renovados: (client_id, sha256(refresh_token)) -> (expires_at, tokens).
+# Evita repetir el round-trip al endpoint de token (y quemar refresh tokens rotativos)
+# cuando varias peticiones renuevan con el mismo refresh token.
+TOKEN_CACHE_MARGIN = 60  # Segundos de margen antes de la expiración real
+_TOKEN_CACHE: Dict[Tuple[str, str], Tuple[float, Dict]] = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+# Renovaciones en curso por la misma clave (protegido por _TOKEN_CACHE_LOCK)
+_INFLIGHT: Dict[Tuple[str, str], threading.Event] = {}
+REFRESH_WAIT_TIMEOUT = 15  # Segundos que un hilo espera la renovación de otro
+
+
+def _token_cache_key(client_id: str, refresh_token: str) -> Tuple[str, str]:
+    return (client_id, hashlib.sha256(refresh_token.encode()).hexdigest())
+
+
+def invalidate_token(client_id: str, refresh_token: str) -> None:
+    """Descarta el token cacheado para este refresh token (p. ej. si Graph devolvió 401)."""
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE.pop(_token_cache_key(client_id, refresh_token), None)
+
+
+def close_session() -> None:
+    """Cierra las conexiones abiertas de la sesión compartida (p. ej. en teardown)."""
+    _SESSION.close()
+
+
+def reset_session_after_fork() -> None:
+    """
+    Reemplaza la sesión en el proceso hijo tras un fork (gunicorn --preload):
+    sin cerrar la heredada, cuyos sockets siguen siendo del proceso padre.
+    """
+    global _SESSION, _TOKEN_CACHE_LOCK
+    _SESSION = _build_session()
+    _TOKEN_CACHE_LOCK = threading.Lock()  # Pudo quedar tomado por otro hilo del padre
+    _INFLIGHT.clear()  # Renovaciones de hilos del padre que nunca terminarán aquí
 
 
 def get_device_code(client_id: str, tenant_id: str = DEFAULT_TENANT_ID) -> Dict:
@@ -104,7 +201,7 @@ def get_device_code(client_id: str, tenant_id: str = DEFAULT_TENANT_ID) -> Dict:
     - El intervalo de polling debe respetarse para evitar rate limiting
     """
     # Construir URL del endpoint de device code
-    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/devicecode"
+    url = _devicecode_url(tenant_id)
     
     # Preparar payload con client_id y scopes solicitados
     payload = {
@@ -116,10 +213,11 @@ def get_device_code(client_id: str, tenant_id: str = DEFAULT_TENANT_ID) -> Dict:
     
     try:
         # Realizar petición POST al endpoint
-        response = requests.post(url, data=payload, timeout=10)
+        response = _SESSION.post(url, data=payload, timeout=REQUEST_TIMEOUT)
         
-        # Parsear respuesta JSON
-        data = response.json()
+        # Parsear respuesta JSON (un cuerpo no JSON, p. ej. una página HTML de
+        # error de un proxy, cae en el except junto con los errores de red)
+        data = orjson.loads(response.content)
         
         # Verificar si hubo error
         if response.status_code != 200:
@@ -146,7 +244,7 @@ def get_device_code(client_id: str, tenant_id: str = DEFAULT_TENANT_ID) -> Dict:
         logger.error("Timeout al solicitar device code")
         return {'error': 'timeout', 'error_description': 'Request timed out'}
     
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         logger.error(f"Error de red al solicitar device code: {str(e)}", exc_info=True)
         return {'error': 'network_error', 'error_description': str(e)}
 
@@ -155,7 +253,8 @@ def poll_for_token(
     client_id: str,
     device_code: str,
     interval: int = DEFAULT_POLL_INTERVAL,
-    tenant_id: str = DEFAULT_TENANT_ID
+    tenant_id: str = DEFAULT_TENANT_ID,
+    expires_in: int = DEFAULT_DEVICE_CODE_EXPIRES_IN
 ) -> Dict:
     """
     Consulta (polling) el endpoint de token hasta que el usuario complete la autenticación.
@@ -168,7 +267,7 @@ def poll_for_token(
     - Ocurra un error de red (fallo)
     
     ⚠️ IMPORTANTE: Este método es BLOQUEANTE y puede tardar varios minutos.
-    En una aplicación web, esto debería ejecutarse de forma asíncrona o en background.
+    En una aplicación web usar poll_token_once() y repetir desde el cliente.
     
     Args:
         client_id (str): Application (client) ID de Azure AD
@@ -176,6 +275,8 @@ def poll_for_token(
         interval (int): Segundos entre intentos de polling (default: 5)
                         Debe respetar el valor retornado por get_device_code()
         tenant_id (str): Tenant ID de Azure AD (default: "consumers")
+        expires_in (int): Vida del device code en segundos (default: 900).
+                          Pasado ese tiempo se corta sin otra petición HTTP.
     
     Returns:
         Dict: En caso de éxito, retorna tokens:
@@ -222,77 +323,165 @@ def poll_for_token(
     Notas de Implementación:
     ------------------------
     - Este método NO debe usarse directamente en vistas de Django
-    - Para aplicaciones web, usar Celery o similar para ejecutar en background
+    - Para aplicaciones web, usar poll_token_once() desde el endpoint de polling
     - Respetar el intervalo de polling para evitar rate limiting (429 Too Many Requests)
     - El access_token expira en ~1 hora, usar refresh_token para renovar
     """
-    # Construir URL del endpoint de token
-    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    
-    # Preparar payload para solicitud de token
-    payload = {
-        'grant_type': 'urn:ietf:params:oauth:grant-type:device_code',
-        'client_id': client_id,
-        'device_code': device_code
-    }
+    # URL y payload no cambian entre intentos: construirlos una sola vez
+    url = _token_url(tenant_id)
+    payload = _device_code_payload(client_id, device_code)
     
     logger.info(f"Iniciando polling para token (intervalo: {interval}s)")
     poll_count = 0
+    backoff = interval
+    started = time.monotonic()
+    
+    # Referencias locales para el loop (LOAD_FAST en vez de búsquedas globales/atributos)
+    _poll, _sleep, _monotonic, _debug = _poll_token, time.sleep, time.monotonic, logger.debug
     
     # Loop de polling (bloqueante)
     while True:
+        if _monotonic() - started > expires_in:
+            logger.warning(f"Device code expiró localmente después de {poll_count} intentos")
+            return {'error': 'expired_token', 'error_description': 'local timeout'}
+        
         poll_count += 1
-        logger.debug(f"Intento de polling #{poll_count}")
+        _debug("Intento de polling #%d", poll_count)
         
-        try:
-            # Realizar petición POST al endpoint
-            response = requests.post(url, data=payload, timeout=10)
-            data = response.json()
-            
-            # Caso 1: Éxito - Usuario completó autenticación
-            if response.status_code == 200:
+        data = _poll(url, payload)
+        error = data.get('error')
+        
+        # Éxito - Usuario completó autenticación
+        if error is None:
+            logger.info(f"Autenticación exitosa después de {poll_count} intentos")
+            return data
+        
+        # Cualquier error no transitorio - Detener polling
+        if error not in RETRYABLE_POLL_ERRORS:
+            return data
+        
+        if error == 'authorization_pending':
+            # Round-trip correcto: reiniciar el backoff y espaciar los intentos de
+            # forma creciente (nunca por debajo del intervalo oficial)
+            backoff = interval
+            _sleep(max(interval, min(interval * 1.5 ** min(poll_count, 4), MAX_POLL_INTERVAL)))
+        elif error == 'slow_down':
+            interval += SLOW_DOWN_INCREMENT
+            backoff = interval
+            _sleep(interval)
+        else:
+            # 429 / 5xx tras agotar los reintentos de urllib3: Retry-After si vino,
+            # si no backoff exponencial con jitter
+            delay = data.get('retry_after')
+            if delay is None:
+                delay = min(backoff, MAX_POLL_BACKOFF)
+                delay = random.uniform(delay / 2, delay)
+                backoff = min(backoff * 2, MAX_POLL_BACKOFF)
+            _debug("Error transitorio (%s), reintentando en %.1fs", error, delay)
+            _sleep(delay)
+
+
+# Errores conocidos del endpoint de token: error -> (nivel de log, mensaje, descripción fija)
+_POLL_ERROR_ACTIONS = {
+    'authorization_pending': (logging.DEBUG, "Autorización pendiente, esperando...", None),
+    'slow_down': (logging.DEBUG, "Servidor pidió slow_down, esperando...", None),
+    'authorization_declined': (logging.WARNING, "Usuario rechazó la autorización", 'User declined authorization'),
+    'expired_token': (logging.WARNING, "Device code expiró", 'Device code expired'),
+}
+
+
+def _parse_retry_after(response: requests.Response) -> Optional[int]:
+    """Segundos indicados en el header Retry-After (None si falta o no es numérico)."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        return None
+
+
+def poll_token_once(
+    client_id: str,
+    device_code: str,
+    tenant_id: str = DEFAULT_TENANT_ID
+) -> Dict:
+    """
+    Realiza UN solo intento contra el endpoint de token del Device Code Flow.
+    
+    Versión no bloqueante de poll_for_token(): no duerme ni reintenta, así que
+    el worker de Django queda libre entre intentos y es el cliente (navegador)
+    quien repite la consulta respetando el intervalo.
+    
+    Args:
+        client_id (str): Application (client) ID de Azure AD
+        device_code (str): Device code obtenido de get_device_code()
+        tenant_id (str): Tenant ID de Azure AD (default: "consumers")
+    
+    Returns:
+        Dict: Tokens en caso de éxito, o {'error', 'error_description'}.
+              Los errores de RETRYABLE_POLL_ERRORS indican que se debe reintentar;
+              ante 429/5xx se incluye 'retry_after' (segundos o None).
+    """
+    return _poll_token(_token_url(tenant_id), _device_code_payload(client_id, device_code))
+
+
+def _device_code_payload(client_id: str, device_code: str) -> Dict[str, str]:
+    return {
+        'grant_type': 'urn:ietf:params:oauth:grant-type:device_code',
+        'client_id': client_id,
+        'device_code': device_code
+    }
+
+
+def _poll_token(url: str, payload: Dict[str, str]) -> Dict:
+    """Intento de polling con URL y payload ya construidos (ver poll_token_once)."""
+    try:
+        # Realizar petición POST al endpoint
+        response = _SESSION.post(url, data=payload, timeout=REQUEST_TIMEOUT)
+        
+        # Throttling o error del servidor: transitorio, el cuerpo puede no ser JSON
+        if response.status_code == 429 or response.status_code >= 500:
+            logger.warning("Endpoint de token respondió %d durante polling", response.status_code)
+            return {
+                'error': 'temporarily_unavailable',
+                'error_description': f'HTTP {response.status_code}',
+                'retry_after': _parse_retry_after(response),
+            }
+        
+        data = orjson.loads(response.content)
+        
+        # Caso 1: Éxito - Usuario completó autenticación
+        if response.status_code == 200:
+            if logger.isEnabledFor(logging.INFO):
                 logger.info(
-                    f"Autenticación exitosa después de {poll_count} intentos",
+                    "Token obtenido exitosamente",
                     extra={'has_refresh_token': 'refresh_token' in data}
                 )
-                return data
-            
-            # Caso 2: Error - Analizar tipo de error
-            error = data.get('error')
-            error_description = data.get('error_description', '')
-            
-            # Caso 2a: Autorización pendiente - Continuar polling
-            if error == 'authorization_pending':
-                logger.debug("Autorización pendiente, esperando...")
-                time.sleep(interval)
-                continue
-            
-            # Caso 2b: Usuario rechazó - Detener polling
-            elif error == 'authorization_declined':
-                logger.warning("Usuario rechazó la autorización")
-                return {'error': error, 'error_description': 'User declined authorization'}
-            
-            # Caso 2c: Código expiró - Detener polling
-            elif error == 'expired_token':
-                logger.warning(f"Device code expiró después de {poll_count} intentos")
-                return {'error': error, 'error_description': 'Device code expired'}
-            
-            # Caso 2d: Otro error - Detener polling
-            else:
-                logger.error(
-                    f"Error inesperado durante polling: {error}",
-                    extra={'error_description': error_description}
-                )
-                return {'error': error, 'error_description': error_description}
-                
-        except requests.exceptions.Timeout:
-            logger.warning(f"Timeout en intento de polling #{poll_count}, reintentando...")
-            time.sleep(interval)
-            continue
+            return data
+        
+        # Caso 2: Error - Resolver la acción con una sola búsqueda en la tabla
+        error, error_description = data.get('error'), data.get('error_description', '')
+        action = _POLL_ERROR_ACTIONS.get(error)
+        
+        # Caso 2d: Error no contemplado
+        if action is None:
+            logger.error(
+                f"Error inesperado durante polling: {error}",
+                extra={'error_description': error_description}
+            )
+            return {'error': error, 'error_description': error_description}
+        
+        # Casos 2a-2c: pendiente / slow_down (reintentar), rechazo o expiración
+        level, message, fixed_description = action
+        logger.log(level, message)
+        return {'error': error, 'error_description': fixed_description or error_description}
             
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error de red durante polling: {str(e)}", exc_info=True)
-            return {'error': 'network_error', 'error_description': str(e)}
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        # Los reintentos de urllib3 ya se agotaron: fallo terminal
+        # Sin traceback: con red inestable se repite en cada intento de polling
+        logger.error("Error de red durante polling: %s", e)
+        return {'error': 'network_error', 'error_description': str(e)}
 
 
 def refresh_access_token(
@@ -350,9 +539,47 @@ def refresh_access_token(
     - Microsoft puede retornar un nuevo refresh_token en la respuesta
     - Siempre actualizar AMBOS tokens si se recibe nuevo refresh_token
     - Si falla, el usuario debe completar el flujo de autenticación nuevamente
+    - Mientras el token renovado siga vigente (margen de 60s) se devuelve desde
+      el cache en proceso; usar invalidate_token() si Graph lo rechaza
     """
+    cache_key = _token_cache_key(client_id, refresh_token)
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(cache_key)
+        if cached and cached[0] > time.time() + TOKEN_CACHE_MARGIN:
+            logger.debug("Access token vigente en cache para client_id: %s...", client_id[:8])
+            return cached[1]
+        
+        # Single-flight: solo un hilo renueva por refresh token, el resto espera su resultado
+        event = _INFLIGHT.get(cache_key)
+        is_leader = event is None
+        if is_leader:
+            event = _INFLIGHT[cache_key] = threading.Event()
+    
+    if not is_leader:
+        logger.debug("Renovación en curso para client_id: %s..., esperando resultado", client_id[:8])
+        event.wait(timeout=REFRESH_WAIT_TIMEOUT)
+        with _TOKEN_CACHE_LOCK:
+            cached = _TOKEN_CACHE.get(cache_key)
+        # Si el hilo líder falló, reintentar con el mismo refresh token fallaría igual
+        return cached[1] if cached and cached[0] > time.time() else None
+    
+    try:
+        return _request_token_refresh(client_id, refresh_token, tenant_id, cache_key)
+    finally:
+        with _TOKEN_CACHE_LOCK:
+            _INFLIGHT.pop(cache_key, None)
+        event.set()
+
+
+def _request_token_refresh(
+    client_id: str,
+    refresh_token: str,
+    tenant_id: str,
+    cache_key: Tuple[str, str]
+) -> Optional[Dict]:
+    """Petición HTTP de renovación; guarda el resultado en _TOKEN_CACHE si tiene éxito."""
     # Construir URL del endpoint de token
-    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+    url = _token_url(tenant_id)
     
     # Preparar payload para renovación de token
     payload = {
@@ -362,26 +589,34 @@ def refresh_access_token(
         'grant_type': 'refresh_token'
     }
     
-    logger.info(f"Intentando renovar access token para client_id: {client_id[:8]}...")
+    logger.info("Intentando renovar access token para client_id: %s...", client_id[:8])
     
     try:
         # Realizar petición POST al endpoint
-        response = requests.post(url, data=payload, timeout=10)
+        response = _SESSION.post(url, data=payload, timeout=REQUEST_TIMEOUT)
         
         # Verificar respuesta
         if response.status_code == 200:
-            data = response.json()
-            logger.info(
-                "Access token renovado exitosamente",
-                extra={
-                    'expires_in': data.get('expires_in'),
-                    'has_new_refresh_token': 'refresh_token' in data
-                }
-            )
+            data = orjson.loads(response.content)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Access token renovado exitosamente",
+                    extra={
+                        'expires_in': data.get('expires_in'),
+                        'has_new_refresh_token': 'refresh_token' in data
+                    }
+                )
+            now = time.time()
+            expires_at = now + int(data.get('expires_in', 0))
+            with _TOKEN_CACHE_LOCK:
+                # Purgar entradas vencidas para que el dict no crezca sin límite
+                for key in [k for k, (exp, _) in _TOKEN_CACHE.items() if exp <= now]:
+                    del _TOKEN_CACHE[key]
+                _TOKEN_CACHE[cache_key] = (expires_at, data)
             return data
         else:
             # Error al renovar
-            error_data = response.json()
+            error_data = orjson.loads(response.content)
             logger.error(
                 f"Error renovando token: {error_data.get('error')}",
                 extra={
@@ -395,6 +630,6 @@ def refresh_access_token(
         logger.error("Timeout al renovar access token")
         return None
     
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         logger.error(f"Error de red al renovar token: {str(e)}", exc_info=True)
         return None
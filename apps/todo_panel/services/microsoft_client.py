@@ -1,14 +1,103 @@
 import logging
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ..models import MicrosoftUser
-from .encryption import decrypt_data
-from .microsoft_auth import refresh_access_token
+from .cache_optimizer import CacheOptimizer
+from .attachment_storage import (
+    attachment_cache_key, attachment_file_exists, get_attachment_ref, store_attachment,
+    touch_attachment
+)
+from .encryption import decrypt_cached, decrypt_many_cached, forget_decrypted
+from .microsoft_auth import invalidate_token, refresh_access_token
+from django.conf import settings
 from django.core.cache import cache
+from django.core.files import File
 from typing import Dict, List, Optional
-import base64
+import threading
+from contextlib import closing
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# Sesión HTTP compartida por todas las instancias de MicrosoftClient: cada
+# request de Django crea su propio cliente, así que una sesión por instancia
+# no llegaba a reutilizar conexiones. Todas las llamadas van a
+# graph.microsoft.com; keep-alive + pool evitan un handshake TCP+TLS por página.
+_SESSION: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        # Sin bloquear: si hay más hilos que conexiones, las sobrantes se abren
+        # y se descartan al terminar, pagando un handshake cada vez
+        pool_maxsize=getattr(settings, 'GRAPH_HTTP_POOL_MAXSIZE', 50),
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def _get_shared_session() -> requests.Session:
+    """Retorna la sesión compartida, creándola en el primer uso."""
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = _build_session()
+    return _SESSION
+
+
+def close_session() -> None:
+    """Cierra la sesión compartida y libera las conexiones del pool."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+            _SESSION = None
+
+
+def reset_session_after_fork() -> None:
+    """
+    Descarta en el proceso hijo la sesión heredada tras un fork: sin cerrarla,
+    porque sus sockets siguen siendo del padre. La próxima llamada crea una
+    propia en _get_shared_session().
+    """
+    global _SESSION, _SESSION_LOCK
+    _SESSION = None
+    _SESSION_LOCK = threading.Lock()  # Pudo quedar tomado por otro hilo del padre
+    MicrosoftClient._REFRESH_LOCKS = tuple(
+        threading.Lock() for _ in range(MicrosoftClient.REFRESH_LOCK_STRIPES)
+    )
+
+
+def _parse_json(response: requests.Response):
+    """
+    orjson.loads del cuerpo. Un cuerpo no JSON (página HTML de error, cuerpo
+    vacío) se relanza como requests.JSONDecodeError, un RequestException,
+    igual que response.json(), para que lo atrapen los manejadores existentes.
+    """
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos, response=response) from e
+
+
+class DeltaLinkExpired(Exception):
+    """El deltaLink guardado ya no es válido (410 Gone): requiere sincronización completa."""
+
+
 class MicrosoftClient:
     """
     Cliente para interactuar con Microsoft Graph API.
@@ -17,46 +106,189 @@ class MicrosoftClient:
     """
     
     BASE_URL = "https://graph.microsoft.com/v1.0"
+    MAX_CONCURRENT_BATCHES = 4  # Lotes $batch simultáneos (20 páginas c/u)
+    BATCH_MAX_THROTTLE_RETRIES = 3  # Reintentos de sub-peticiones 429 antes de rendirse
+    
+    # Renovación single-flight entre procesos: un solo worker llama al endpoint
+    # de tokens y el resto toma su resultado desde la caché
+    REFRESH_LOCK_TIMEOUT = 30
+    REFRESH_RESULT_TTL = 30
+    REFRESH_WAIT_INTERVAL = 0.2
+    LISTS_FRESH_TTL = 300  # Listas servidas de caché sin consultar a Graph
+    LISTS_ETAG_TTL = 86400  # Con ETag la única copia se conserva para revalidarla con 304
+    # Locks a rayas: tamaño fijo aunque crezca la cantidad de usuarios; dos
+    # usuarios que compartan raya solo serializan sus renovaciones
+    REFRESH_LOCK_STRIPES = 64
+    _REFRESH_LOCKS = tuple(threading.Lock() for _ in range(REFRESH_LOCK_STRIPES))
+    # Borra refresh_lock:{uid} solo si su valor sigue siendo el del dueño
+    _RELEASE_LOCK_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+    _release_script = None  # redis-py Script, registrado en el primer uso
+    
+    # Solo los campos que consumen las vistas y la exportación (payload más chico)
+    LIST_SELECT = "id,displayName,isOwner"
+    TASK_SELECT = (
+        "id,title,status,importance,isReminderOn,createdDateTime,"
+        "dueDateTime,reminderDateTime,hasAttachments,body"
+    )
+    TASK_EXPAND = "checklistItems,attachments"
+    TASKS_PAGE_SIZE = 100  # Máximo de $top que acepta To Do (el $batch por $skip asume este valor)
+    TASKS_QUERY = f"$top={TASKS_PAGE_SIZE}&$select={TASK_SELECT}&$expand={TASK_EXPAND}"
+    
+    # URLs inmutables precalculadas una sola vez al definir la clase
+    LISTS_URL = f"{BASE_URL}/me/todo/lists?$top=100&$select={LIST_SELECT}"
+    TASKS_URL_TEMPLATE = f"{BASE_URL}/me/todo/lists/{{}}/tasks?{TASKS_QUERY}"
+    PROFILE_URL = f"{BASE_URL}/me"
+    BATCH_URL = f"{BASE_URL}/$batch"
+    LISTS_FILTER_URL = f"{BASE_URL}/me/todo/lists?$select={LIST_SELECT}&$filter="
+    TASKS_BASE_URL_TEMPLATE = f"{BASE_URL}/me/todo/lists/{{}}/tasks"
+    TASKS_DELTA_URL_TEMPLATE = f"{BASE_URL}/me/todo/lists/{{}}/tasks/delta"
+    TASKS_COUNT_URL_TEMPLATE = f"{BASE_URL}/me/todo/lists/{{}}/tasks?$top=1&$count=true"
+    ATTACHMENT_URL_TEMPLATE = f"{BASE_URL}/me/todo/lists/{{}}/tasks/{{}}/attachments/{{}}"
+    ATTACHMENT_VALUE_URL_TEMPLATE = ATTACHMENT_URL_TEMPLATE + "/$value"
+    # Rutas relativas para sub-peticiones de $batch
+    TASKS_BATCH_PATH_TEMPLATE = f"/me/todo/lists/{{}}/tasks?{TASKS_QUERY}"
     
     def __init__(self, user: MicrosoftUser):
         self.user = user
-        self.access_token = decrypt_data(user.encrypted_access_token)
-        self.client_id = decrypt_data(user.encrypted_client_id)
+        # Graph solo necesita el access token; client_id y refresh token se
+        # desencriptan recién cuando hace falta renovar (_refresh_token)
+        # La sesión es compartida entre usuarios: el Authorization va por petición
+        self.session = _get_shared_session()
+        self._set_access_token(decrypt_cached(user.encrypted_access_token))
+        self._refresh_lock = self._user_refresh_lock(user.id)
+        self._lists_index: Optional[Dict[str, Dict]] = None
+
+    @classmethod
+    def _user_refresh_lock(cls, user_id: int) -> threading.Lock:
+        """Lock compartido por todas las instancias del proceso para un mismo usuario."""
+        return cls._REFRESH_LOCKS[user_id % cls.REFRESH_LOCK_STRIPES]
+
+    def close(self):
+        """
+        Compatibilidad: la sesión HTTP es compartida por el proceso y no se
+        cierra por instancia (ver close_session()).
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
         
-    def _get_headers(self):
-        return {
-            "Authorization": f"Bearer {self.access_token}",
+    def _set_access_token(self, access_token: str):
+        """Fija el token y arma los headers una sola vez por rotación."""
+        self.access_token = access_token
+        self._headers = {
+            "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json"
         }
+
+    def _get_headers(self):
+        return self._headers
     
-    def _make_request(self, url, timeout=10):
-        """Realiza una petición GET con manejo automático de token expirado."""
-        response = requests.get(url, headers=self._get_headers(), timeout=timeout)
+    def _get(self, url, timeout=10, stream=False, headers=None) -> requests.Response:
+        """
+        GET a Graph con el token del cliente; ante 401 renueva y reintenta una vez.
+        headers se agrega a los de autenticación (ej: If-None-Match).
+        """
+        response = self.session.get(
+            url, headers={**self._headers, **headers} if headers else self._headers,
+            timeout=timeout, stream=stream
+        )
         
         if response.status_code == 401:
             logger.info("Token expirado, intentando renovar...")
             if self._refresh_token():
-                response = requests.get(url, headers=self._get_headers(), timeout=timeout)
+                response.close()  # Con stream=True la conexión sigue tomada hasta cerrarla
+                response = self.session.get(
+                    url, headers={**self._headers, **headers} if headers else self._headers,
+                    timeout=timeout, stream=stream
+                )
+        
+        return response
+
+    def _make_request(self, url, timeout=10):
+        """Realiza una petición GET con manejo automático de token expirado."""
+        response = self._get(url, timeout=timeout)
         
         if response.status_code == 200:
-            return response.json()
+            return _parse_json(response)
         
         logger.error(f"Error en petición: {response.status_code}")
         return None
+
+    def _batch(self, requests_list: List[Dict]) -> Dict[str, Dict]:
+        """
+        Ejecuta hasta 20 sub-peticiones en una sola llamada a /$batch.
+        
+        Args:
+            requests_list: Sub-peticiones en formato Graph
+                           ({"id": "1", "method": "GET", "url": "/me/..."})
+        
+        Returns:
+            Dict {id: sub-respuesta} con 'status', 'headers' y 'body'.
+            Las sub-respuestas 429 se reintentan respetando Retry-After hasta
+            BATCH_MAX_THROTTLE_RETRIES veces (después queda el último 429 en
+            el resultado) y las 401 una única vez tras renovar el token.
+        """
+        url = self.BATCH_URL
+        pending = list(requests_list)
+        results = {}
+        refreshed = False
+        throttle_retries = 0
+        
+        while pending:
+            response = self.session.post(url, json={'requests': pending}, headers=self._headers, timeout=30)
+            if response.status_code != 200:
+                logger.error(f"Error en petición batch: {response.status_code}")
+                raise Exception(f"Error en batch: {response.status_code} - {response.text}")
+            
+            by_id = {req['id']: req for req in pending}
+            retry, retry_after, unauthorized, throttled = [], 0, False, False
+            
+            for sub in _parse_json(response).get('responses', []):
+                status = sub.get('status')
+                if status == 429 and throttle_retries < self.BATCH_MAX_THROTTLE_RETRIES:
+                    retry.append(by_id[sub['id']])
+                    throttled = True
+                    headers = sub.get('headers') or {}
+                    retry_after = max(retry_after, int(headers.get('Retry-After', 1)))
+                elif status == 401 and not refreshed:
+                    retry.append(by_id[sub['id']])
+                    unauthorized = True
+                else:
+                    results[sub['id']] = sub
+            
+            if unauthorized:
+                logger.info("Token expirado en batch, intentando renovar...")
+                refreshed = True
+                if not self._refresh_token():
+                    raise Exception("No se pudo renovar el token para el batch")
+            if throttled:
+                throttle_retries += 1
+                logger.warning(f"Batch limitado (429), reintentando en {retry_after}s")
+                time.sleep(retry_after)
+            pending = retry
+        
+        return results
     
     def get_profile(self):
         """
         Obtiene los datos del perfil del usuario de Microsoft Graph.
         """
-        url = f"{self.BASE_URL}/me"
+        url = self.PROFILE_URL
         
         try:
-            response = requests.get(url, headers=self._get_headers())
+            response = self._get(url, timeout=30)
             response.raise_for_status()  # Lanza una excepción para códigos de estado HTTP erróneos
-            return response.json()
+            return _parse_json(response)
         except requests.exceptions.RequestException as e:
             logger.error(f"Error al obtener el perfil de Microsoft: {e}")
-            # Aquí podrías añadir lógica para refrescar el token si el error es 401
             raise
 
     def get_tasks_delta(self, list_id, delta_link=None):
@@ -69,9 +301,12 @@ class MicrosoftClient:
             
         Returns:
             Tuple (list[changes], next_delta_link)
+        
+        Raises:
+            DeltaLinkExpired: Si Graph responde 410 Gone al delta_link.
         """
         # Si tenemos un link delta, lo usamos directamente. Si no, iniciamos delta query.
-        url = delta_link if delta_link else f'{self.BASE_URL}/me/todo/lists/{list_id}/tasks/delta'
+        url = delta_link if delta_link else self.TASKS_DELTA_URL_TEMPLATE.format(list_id)
         
         all_changes = []
         next_link = None
@@ -83,9 +318,14 @@ class MicrosoftClient:
             # Nota: delta query en To Do a veces no soporta expand completos en todas las implementaciones.
             # Por simplicidad y eficiencia, pedimos el delta standard.
             
-            response = self._make_request(url)
-            if not response:
+            raw = self._get(url)
+            if raw.status_code == 410:
+                # El deltaLink expiró o fue invalidado: hay que rehacer la sincronización completa
+                raise DeltaLinkExpired(f"Delta link expirado para lista {list_id}")
+            if raw.status_code != 200:
+                logger.error(f"Error en petición: {raw.status_code}")
                 break
+            response = _parse_json(raw)
                 
             tasks = response.get('value', [])
             all_changes.extend(tasks)
@@ -99,23 +339,54 @@ class MicrosoftClient:
             
         return all_changes, next_link
 
-    def fetch_tasks_pages(self, id_list):
+    @staticmethod
+    def merge_delta(tasks: List[Dict], changes: List[Dict]) -> List[Dict]:
+        """
+        Aplica los cambios de una delta query sobre una lista de tareas.
+        
+        Las entradas con '@removed' se eliminan. Las actualizaciones se
+        combinan con la tarea previa: el delta no trae los $expand
+        (checklistItems, attachments), así que se conservan los ya conocidos.
+        """
+        task_map = {task['id']: task for task in tasks}
+        for change in changes:
+            change_id = change['id']
+            if '@removed' in change:
+                task_map.pop(change_id, None)
+            else:
+                previous = task_map.get(change_id)
+                task_map[change_id] = {**previous, **change} if previous else change
+        return list(task_map.values())
+
+    def fetch_tasks_pages(self, id_list, select=TASK_SELECT, expand=TASK_EXPAND):
         """
         Generador que obtiene las páginas de tareas de una lista.
         Permite procesar el progreso paso a paso.
+        
+        Args:
+            select: Campos a pedir ($select); None trae todos
+            expand: Relaciones a expandir ($expand); None no expande nada.
+                    Los caminos que no usan subtareas ni adjuntos deberían
+                    pasar None: el $expand es la mayor parte del payload.
         """
-        url = f"{self.BASE_URL}/me/todo/lists/{id_list}/tasks?$top=100&$expand=checklistItems,linkedResources,attachments"
+        if select == self.TASK_SELECT and expand == self.TASK_EXPAND:
+            url = self.TASKS_URL_TEMPLATE.format(id_list)
+        else:
+            query = f"$top={self.TASKS_PAGE_SIZE}"
+            if select:
+                query += f"&$select={select}"
+            if expand:
+                query += f"&$expand={expand}"
+            url = f"{self.TASKS_BASE_URL_TEMPLATE.format(id_list)}?{query}"
+        yield from self._iter_task_pages(url)
+
+    def _iter_task_pages(self, url):
+        """Recorre las páginas de tareas a partir de una URL (primera página o nextLink)."""
         while url:
-            # logger.debug(f"Fetching URL: {url}")
-            response = requests.get(url, headers=self._get_headers())
-            
-            if response.status_code == 401:
-                logger.info("Token expirado, intentando renovar...")
-                if self._refresh_token():
-                     response = requests.get(url, headers=self._get_headers())
+            response = self._get(url, timeout=30)
 
             if response.status_code == 200:
-                data = response.json()
+                data = _parse_json(response)
                 tasks_page = data.get('value', [])
                 if not tasks_page:
                     break
@@ -127,63 +398,179 @@ class MicrosoftClient:
                 logger.error(f"Error fetching tasks page: {response.status_code}")
                 raise Exception(f"Error al obtener tareas: {response.status_code} - {response.text}")
 
+    def fetch_tasks_pages_batched(self, id_list, total_count):
+        """
+        Variante de fetch_tasks_pages que usa $batch cuando se conoce el total.
+        
+        Con el total se pueden calcular todas las páginas por $skip y pedirlas
+        de a 20 en una sola llamada HTTP, con hasta MAX_CONCURRENT_BATCHES lotes
+        en vuelo a la vez. Si no hay total, usa la paginación secuencial por
+        @odata.nextLink.
+        
+        Las páginas se ordenan por createdDateTime para que $skip sea estable
+        y las tareas se deduplican por id. Si una sub-petición falla (incluido
+        un 429 persistente) o el total no cierra porque la lista cambió
+        durante la carga, se completa con la paginación secuencial, que solo
+        entrega las tareas que todavía no se vieron.
+        """
+        if not total_count:
+            yield from self.fetch_tasks_pages(id_list)
+            return
+        
+        seen = set()
+        
+        def unseen(page):
+            new = [task for task in page if task['id'] not in seen]
+            seen.update(task['id'] for task in new)
+            return new
+        
+        path = self.TASKS_BATCH_PATH_TEMPLATE.format(id_list)
+        skips = list(range(0, total_count, 100))
+        chunks = [skips[start:start + 20] for start in range(0, len(skips), 20)]
+        batches = [
+            [
+                {'id': str(skip), 'method': 'GET', 'url': f"{path}&$orderby=createdDateTime&$skip={skip}"}
+                for skip in chunk
+            ]
+            for chunk in chunks
+        ]
+        
+        # Los lotes son independientes: se envían en paralelo sobre el pool de la sesión
+        # y se consumen en orden para conservar la secuencia de páginas.
+        complete = True
+        with ThreadPoolExecutor(max_workers=min(self.MAX_CONCURRENT_BATCHES, len(batches))) as executor:
+            try:
+                for chunk, responses in zip(chunks, executor.map(self._batch, batches)):
+                    for skip in chunk:
+                        sub = responses.get(str(skip), {})
+                        if sub.get('status') != 200:
+                            logger.warning(f"Página de tareas fallida en batch ($skip={skip}): {sub.get('status')}")
+                            complete = False
+                            break
+                        tasks_page = unseen(sub.get('body', {}).get('value', []))
+                        if tasks_page:
+                            yield tasks_page
+                    if not complete:
+                        break
+            except Exception as e:
+                logger.warning(f"Error en batch de tareas para lista {id_list}: {e}")
+                complete = False
+        
+        if not complete or len(seen) != total_count:
+            logger.info(
+                f"Carga por batch incompleta para lista {id_list} "
+                f"({len(seen)}/{total_count}), completando en forma secuencial"
+            )
+            for page in self.fetch_tasks_pages(id_list):
+                tasks_page = unseen(page)
+                if tasks_page:
+                    yield tasks_page
+
     def get_tasks_by_list_id(self, id_list, force_refresh=False):
         """
         Obtiene las tareas de una lista específica.
-        Ahora usa el generador fetch_tasks_pages.
+        
+        Con force_refresh se recorre la lista completa (iter_tasks_by_list_id)
+        con sus $expand: la exportación lo usa para tener adjuntos y subtareas
+        al día, cosa que una ronda delta no garantiza. La actualización
+        incremental por delta vive en TaskService.sync_tasks_incremental, que
+        mantiene el único deltaLink de la lista.
         """
         cache_key = f"tasks_{self.user.id}_{id_list}"
         
         if not force_refresh:
-            cached_tasks = cache.get(cache_key)
+            cached_tasks = CacheOptimizer.get_compressed(cache_key)
             if cached_tasks:
                 logger.info(f"Retornando tareas desde caché para lista {id_list}")
                 return cached_tasks
 
-        tasks = []
+        return [task for page in self.iter_tasks_by_list_id(id_list, force_refresh=True) for task in page]
+
+    def iter_tasks_by_list_id(self, id_list, force_refresh=False):
+        """
+        Genera las páginas de tareas de una lista a medida que llegan de Graph,
+        para que el consumidor empiece con la primera sin esperar el resto.
+        
+        La lista completa se cachea recién al agotarse el generador; si el
+        consumidor corta antes, no se guarda una lista parcial. Sin
+        force_refresh, una caché vigente se entrega como una sola página.
+        """
+        cache_key = f"tasks_{self.user.id}_{id_list}"
+        if not force_refresh:
+            cached_tasks = CacheOptimizer.get_compressed(cache_key)
+            if cached_tasks:
+                yield cached_tasks
+                return
+        
+        collected = []
         for page in self.fetch_tasks_pages(id_list):
-            tasks.extend(page)
+            collected.extend(page)
+            yield page
         
-        # Guardar en caché
-        cache.set(cache_key, tasks, timeout=300)
-        return tasks
+        # Guardar en caché (comprimido, misma entrada que usa TaskService)
+        CacheOptimizer.set_compressed(cache_key, collected, timeout=300)
 
     def get_tasks(self):
         """
         Obtiene las listas de tareas del usuario.
+        
+        Hay una sola copia en caché ({'etag', 'lists'}) y una marca chica de
+        frescura de LISTS_FRESH_TTL. Vencida la marca, si la copia tiene ETag
+        se revalida con If-None-Match: un 304 la reutiliza sin descargar ni
+        parsear y solo renueva la marca.
         """
         # Intentar obtener del caché primero
         cache_key = f"user_tasks_{self.user.id}"
-        cached_data = cache.get(cache_key)
+        fresh_key = f"user_tasks_fresh_{self.user.id}"
+        cached_data = CacheOptimizer.get_compressed(cache_key)
+        if not isinstance(cached_data, dict):
+            cached_data = None  # Formato anterior (lista sola): se descarta
         
-        if cached_data:
+        if cached_data and cache.get(fresh_key):
             logger.info(f"Retornando tareas desde caché para usuario {self.user.id}")
-            return cached_data
+            return cached_data['lists']
 
+        validated = cached_data if cached_data and cached_data.get('etag') else None
         lists = []
-        url = f"{self.BASE_URL}/me/todo/lists?$top=100"
+        url = self.LISTS_URL
+        etag = None
+        pages = 0
         
         try:
             while url:
-                response = requests.get(url, headers=self._get_headers(), timeout=10)
-
-                if response.status_code == 401:
-                    logger.info("Token expirado, intentando renovar...")
-                    if self._refresh_token():
-                        # Reintentar con nuevo token
-                        response = requests.get(url, headers=self._get_headers(), timeout=10)
+                conditional = validated if pages == 0 else None
+                response = self._get(
+                    url, timeout=10,
+                    headers={'If-None-Match': conditional['etag']} if conditional else None
+                )
+                
+                if response.status_code == 304 and conditional:
+                    logger.info(f"Listas sin cambios (304) para usuario {self.user.id}")
+                    cache.set(fresh_key, 1, timeout=self.LISTS_FRESH_TTL)
+                    return conditional['lists']
                 
                 if response.status_code == 200:
-                    data = response.json()
+                    if pages == 0:
+                        etag = response.headers.get('ETag')
+                    pages += 1
+                    data = _parse_json(response)
                     lists.extend(data.get('value', []))
                     url = data.get('@odata.nextLink')  # Si hay más páginas, continuar
                 else:
                     logger.error(f"Error obteniendo tareas: {response.status_code} - {response.text}")
                     return None
             
-            # Guardar en caché por 5 minutos (300 segundos) si obtuvimos datos
+            # Guardar en caché si obtuvimos datos. El ETag describe solo la
+            # primera página: con varias no sirve para validar y la copia vive
+            # lo mismo que la marca de frescura
             if lists:
-                cache.set(cache_key, lists, timeout=300)
+                if pages > 1:
+                    etag = None
+                CacheOptimizer.set_compressed(
+                    cache_key, {'etag': etag, 'lists': lists},
+                    timeout=self.LISTS_ETAG_TTL if etag else self.LISTS_FRESH_TTL
+                )
+                cache.set(fresh_key, 1, timeout=self.LISTS_FRESH_TTL)
                 
             return lists
             
@@ -192,66 +579,88 @@ class MicrosoftClient:
             return None
 
     def get_tasks_by_name(self, list_name:str) ->  Optional[Dict]:
-        tareas = self.get_tasks()
-        if tareas and 'value' in tareas:
-            for tarea in tareas['value']:
-                # logger.debug(f"Tarea: {tarea}")
-                if tarea['displayName'].lower() == list_name.lower():
-                    return tarea
-        return None
+        """
+        Busca una lista por nombre dejando que Graph haga el filtro ($filter),
+        en lugar de paginar todas las listas y comparar en Python.
+        
+        El resultado se memoiza en caché por usuario y nombre en minúsculas.
+        Solo se guarda el par {id, displayName}, no el cuerpo completo de la
+        lista; usar refresh_lists() para invalidarlo.
+        """
+        name_key = list_name.lower()
+        index_key = f"list_names_{self.user.id}"
+        index = cache.get(index_key) or {}
+        if name_key in index:
+            return index[name_key]
+
+        escaped = list_name.replace("'", "''")  # Escapado OData de comillas simples
+        url = f"{self.LISTS_FILTER_URL}displayName eq '{escaped}'"
+        response = self._make_request(url)
+        if not response or not response.get('value'):
+            return None
+
+        found = response['value'][0]
+        index[name_key] = {'id': found['id'], 'displayName': found['displayName']}
+        cache.set(index_key, index, timeout=300)
+        return index[name_key]
+
+    def refresh_lists(self):
+        """Invalida las listas cacheadas y el índice de nombres del usuario."""
+        self._lists_index = None
+        CacheOptimizer.delete_compressed(f"user_tasks_{self.user.id}")
+        cache.delete_many([f"user_tasks_fresh_{self.user.id}", f"list_names_{self.user.id}"])
     
+    def _lists_by_id(self) -> Dict[str, Dict]:
+        """
+        Índice {id: lista} construido una vez por instancia a partir de get_tasks().
+        Si get_tasks() falla no se memoiza, para reintentar en la próxima llamada.
+        """
+        if self._lists_index is None:
+            lists = self.get_tasks()
+            if not lists:
+                return {}
+            self._lists_index = {item['id']: item for item in lists}
+        return self._lists_index
+
     def get_tasks_list_name(self, list_id:str) ->  Optional[str]:
-        tareas = self.get_tasks()
-        for tarea in tareas:
-            if tarea['id'] == list_id:
-                return tarea['displayName']
-        return None
+        tarea = self._lists_by_id().get(list_id)
+        return tarea['displayName'] if tarea else None
 
     def get_tasks_by_id(self, list_id:str) ->  Optional[Dict]:
-        tareas = self.get_tasks()
-        if tareas and 'value' in tareas:
-            for tarea in tareas['value']:
-                if tarea['id'] == list_id:
-                    return tarea
-        return None
+        return self._lists_by_id().get(list_id)
         
 
     
     def get_attachment(self, list_id: str, task_id: str, attachment_id: str) -> Dict:
         """Obtiene los detalles completos de un adjunto, incluyendo contentBytes"""
-        url = f"{self.BASE_URL}/me/todo/lists/{list_id}/tasks/{task_id}/attachments/{attachment_id}"
-        response = requests.get(url, headers=self._get_headers())
+        url = self.ATTACHMENT_URL_TEMPLATE.format(list_id, task_id, attachment_id)
+        response = self._get(url, timeout=30)
         if response.status_code == 200:
-            return response.json()
+            return _parse_json(response)
         raise Exception(f"Error al obtener adjunto: {response.status_code} - {response.text}")
 
     def save_attachment(self, list_id: str, task_id: str, attachment_id: str) -> str:
         """
-        Descarga un adjunto y lo guarda temporalmente en caché (Redis) por 5 minutos.
-        Retorna la clave de caché del adjunto.
+        Descarga un adjunto en streaming, lo guarda en default_storage y cachea su referencia
+        por 5 minutos (ver attachment_storage). Retorna la clave de caché del adjunto.
         """
-        cache_key = f"microsoft_attachment:{list_id}:{task_id}:{attachment_id}"
+        cache_key = attachment_cache_key(list_id, task_id, attachment_id)
         
-        # Intentar obtener del caché primero para evitar re-descargar
-        cached_content = cache.get(cache_key)
-        if cached_content:
-            # Si ya está en caché, refrescar la expiración y devolver la clave
-            cache.set(cache_key, cached_content, timeout=300)  # 5 minutos
+        # Si la referencia sigue en caché (y la purga no borró el archivo),
+        # solo extender su expiración
+        ref = get_attachment_ref(cache_key)
+        if ref and attachment_file_exists(ref):
+            touch_attachment(cache_key)
             return cache_key
             
-        attachment = self.get_attachment(list_id, task_id, attachment_id)
-        if attachment.get('@odata.type') != '#microsoft.graph.taskFileAttachment':
-            raise Exception("El adjunto no es un archivo (taskFileAttachment)")
-        
-        content_bytes_b64 = attachment.get('contentBytes')
-        if not content_bytes_b64:
-            raise Exception("No se encontró contenido en el adjunto")
-            
-        # Decodificar el contenido antes de guardarlo en caché
-        decoded_content = base64.b64decode(content_bytes_b64)
-        
-        # Guardar el contenido decodificado en caché por 5 minutos (300 segundos)
-        cache.set(cache_key, decoded_content, timeout=300)
+        # /$value devuelve el binario tal cual: sin JSON ni base64, y se copia al
+        # storage en bloques en lugar de tener el archivo entero en memoria
+        url = self.ATTACHMENT_VALUE_URL_TEMPLATE.format(list_id, task_id, attachment_id)
+        with closing(self._get(url, timeout=30, stream=True)) as response:
+            if response.status_code != 200:
+                raise Exception(f"Error al obtener adjunto: {response.status_code} - {response.text}")
+            response.raw.decode_content = True
+            store_attachment(cache_key, File(response.raw))
             
         return cache_key
           
@@ -259,23 +668,151 @@ class MicrosoftClient:
         """
         Intenta renovar el access token usando el refresh token.
         Actualiza el usuario en la DB si tiene éxito.
+        
+        Single-flight por usuario: dentro del proceso lo serializa un
+        threading.Lock y entre procesos un cache.add (SET NX EX en Redis).
+        Solo el ganador llama al endpoint de tokens y guarda en la DB; el resto
+        adopta los tokens que deja publicados en refresh_result:{uid}.
+        La espera al ganador de otro proceso se hace fuera del lock a rayas,
+        para no frenar a los demás usuarios de la misma raya.
+        """
+        stale_token = self.access_token
+        lock_key = f"refresh_lock:{self.user.id}"
+        owner = uuid.uuid4().hex
+        
+        renewed = self._renew_if_unlocked(stale_token, lock_key, owner)
+        if renewed is not None:
+            return renewed
+        
+        # Otro worker está renovando: esperar su resultado
+        deadline = time.monotonic() + self.REFRESH_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(self.REFRESH_WAIT_INTERVAL)
+            if self._adopt_refresh_result(stale_token):
+                return True
+            if cache.get(lock_key) is None:
+                break  # El ganador terminó sin publicar tokens (falló o venció el resultado)
+        
+        # El ganador pudo guardar en la DB sin que llegáramos a ver refresh_result
+        if self._reload_tokens(stale_token):
+            return True
+        
+        # Solo renovar si nadie más tiene el lock; si sigue tomado, rendirse
+        renewed = self._renew_if_unlocked(stale_token, lock_key, owner)
+        if renewed is not None:
+            return renewed
+        logger.warning(f"Renovación concurrente de tokens sin resultado para usuario {self.user.id}")
+        return False
+
+    def _renew_if_unlocked(self, stale_token: str, lock_key: str, owner: str) -> Optional[bool]:
+        """
+        Renueva bajo el lock a rayas si el lock entre procesos está libre.
+        
+        Returns:
+            True/False con el resultado, o None si otro worker tiene el lock.
+        """
+        with self._refresh_lock:
+            if self.access_token != stale_token:
+                return True
+            if self._adopt_refresh_result(stale_token):
+                return True
+            if not cache.add(lock_key, owner, timeout=self.REFRESH_LOCK_TIMEOUT):
+                return None
+            try:
+                return self._renew_tokens()
+            finally:
+                self._release_refresh_lock(lock_key, owner)
+
+    @classmethod
+    def _release_refresh_lock(cls, lock_key: str, owner: str) -> None:
+        """
+        Borra el lock solo si sigue siendo de este worker.
+        
+        Si la renovación tardó más que REFRESH_LOCK_TIMEOUT el lock pudo vencer
+        y tomarlo otro worker: comparar y borrar va en un script Lua (atómico).
         """
-        refresh_token = decrypt_data(self.user.encrypted_refresh_token)
+        try:
+            if cls._release_script is None:
+                cls._release_script = cache.client.get_client().register_script(cls._RELEASE_LOCK_SCRIPT)
+            # encode: el valor se compara tal como django-redis lo serializó en cache.add
+            cls._release_script(keys=[cache.make_key(lock_key)], args=[cache.client.encode(owner)])
+        except Exception as e:
+            # El lock vence solo a los REFRESH_LOCK_TIMEOUT segundos
+            logger.error(f"Error liberando {lock_key}: {e}")
+
+    def _reload_tokens(self, stale_token: str) -> bool:
+        """Relee los tokens de la DB; True si otro worker ya guardó un access token nuevo."""
+        self.user.refresh_from_db(fields=['encrypted_access_token', 'encrypted_refresh_token'])
+        access_token = decrypt_cached(self.user.encrypted_access_token)
+        if not access_token or access_token == stale_token:
+            return False
+        self._set_access_token(access_token)
+        return True
+
+    def _adopt_refresh_result(self, stale_token: str) -> bool:
+        """Toma los tokens renovados por otro worker si son más nuevos que stale_token."""
+        result = cache.get(f"refresh_result:{self.user.id}")
+        if not result:
+            return False
+        
+        access_token = decrypt_cached(result['access'])
+        if not access_token or access_token == stale_token:
+            return False
+        
+        # La DB ya la actualizó el ganador: solo sincronizar la instancia en memoria
+        self._set_access_token(access_token)
+        self.user.encrypted_access_token = result['access']
+        if result.get('refresh'):
+            self.user.encrypted_refresh_token = result['refresh']
+        return True
+
+    def _renew_tokens(self) -> bool:
+        # Si el usuario vino de for_request(), traer ambos campos en una sola query
+        deferred = self.user.get_deferred_fields().intersection(MicrosoftUser.objects.REFRESH_FIELDS)
+        if deferred:
+            self.user.refresh_from_db(fields=list(deferred))
+        
+        client_id, refresh_token = decrypt_many_cached(
+            [self.user.encrypted_client_id, self.user.encrypted_refresh_token]
+        )
         if not refresh_token:
             return False
             
-        new_tokens = refresh_access_token(self.client_id, refresh_token)
+        new_tokens = refresh_access_token(client_id, refresh_token)
+        
+        # El cache devolvió el mismo token que Graph acaba de rechazar: forzar renovación real
+        if new_tokens and new_tokens.get('access_token') == self.access_token:
+            invalidate_token(client_id, refresh_token)
+            new_tokens = refresh_access_token(client_id, refresh_token)
         
         if new_tokens and 'access_token' in new_tokens:
             from .encryption import encrypt_data
             
-            self.access_token = new_tokens['access_token']
+            self._set_access_token(new_tokens['access_token'])
+            # Los ciphertexts reemplazados ya no se usarán: sacarlos del cache
+            forget_decrypted(self.user.encrypted_access_token)
             self.user.encrypted_access_token = encrypt_data(self.access_token)
             
+            update_fields = ['encrypted_access_token', 'last_login']
             if 'refresh_token' in new_tokens:
+                forget_decrypted(self.user.encrypted_refresh_token)
                 self.user.encrypted_refresh_token = encrypt_data(new_tokens['refresh_token'])
+                update_fields.append('encrypted_refresh_token')
                 
-            self.user.save()
+            # update_fields explícito: el usuario puede venir cargado con only()
+            self.user.save(update_fields=update_fields)
+            
+            # Publicar el resultado (cifrado) para los workers que esperan el lock;
+            # bytes() porque el refresh token sin rotar viene de la DB como memoryview
+            refresh_blob = self.user.encrypted_refresh_token
+            cache.set(
+                f"refresh_result:{self.user.id}",
+                {
+                    'access': self.user.encrypted_access_token,
+                    'refresh': bytes(refresh_blob) if refresh_blob else None,
+                },
+                timeout=self.REFRESH_RESULT_TTL,
+            )
             return True
             
         return False
\ No newline at end of file
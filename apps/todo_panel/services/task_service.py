@@ -1,7 +1,7 @@
 import threading
 import logging
 from django.core.cache import cache
-from .microsoft_client import MicrosoftClient
+from .microsoft_client import DeltaLinkExpired, MicrosoftClient
 from .cache_optimizer import CacheOptimizer, RateLimiter
 import pandas as pd
 
@@ -43,8 +43,8 @@ class TaskService:
             tasks = []
             count = 0
             
-            # Iterar sobre las páginas
-            for page in self.client.fetch_tasks_pages(list_id):
+            # Iterar sobre las páginas (en lotes de 20 vía $batch si conocemos el total)
+            for page in self.client.fetch_tasks_pages_batched(list_id, total_count):
                 tasks.extend(page)
                 count += len(page)
                 
@@ -94,7 +94,7 @@ class TaskService:
     def _get_total_task_count(self, list_id):
         """Obtiene el conteo total de tareas sin expandir datos (más rápido)."""
         try:
-            url = f"{self.client.BASE_URL}/me/todo/lists/{list_id}/tasks?$top=1&$count=true"
+            url = self.client.TASKS_COUNT_URL_TEMPLATE.format(list_id)
             response = self.client._make_request(url)
             if response and '@odata.count' in response:
                 return response['@odata.count']
@@ -106,14 +106,12 @@ class TaskService:
     def _count_tasks_manually(self, list_id):
         """Cuenta tareas manualmente si @odata.count no está disponible."""
         count = 0
-        url = f"{self.client.BASE_URL}/me/todo/lists/{list_id}/tasks?$top=100&$select=id"
-        while url:
-            response = self.client._make_request(url)
-            if response:
-                count += len(response.get('value', []))
-                url = response.get('@odata.nextLink')
-            else:
-                break
+        try:
+            # Solo IDs y sin $expand: páginas mínimas
+            for page in self.client.fetch_tasks_pages(list_id, select='id', expand=None):
+                count += len(page)
+        except Exception as e:
+            logger.warning(f"Conteo manual de tareas interrumpido: {e}")
         return count
 
     def sync_tasks_incremental(self, list_id):
@@ -152,25 +150,8 @@ class TaskService:
             
             logger.info(f"Incremental Sync: {len(changes)} changes detected.")
             
-            # 3. Aplicar cambios (Patching)
-            # Convertir lista actual a dict {id: task}
-            task_map = {t['id']: t for t in cached_current_tasks}
-            
-            for change in changes:
-                change_id = change['id']
-                
-                # Check for deletion
-                if '@removed' in change:
-                    if change_id in task_map:
-                        del task_map[change_id]
-                else:
-                    # Update or Insert
-                    # El delta puede traer parciales, pero en Graph Tasks suele traer objeto completo
-                    # Si trae parcial, deberíamos hacer merge. Asumimos completo update por ahora.
-                    task_map[change_id] = change
-            
-            # 4. Reconstruir lista y guardar
-            updated_tasks = list(task_map.values())
+            # 3. Aplicar cambios (Patching) y reconstruir la lista
+            updated_tasks = MicrosoftClient.merge_delta(cached_current_tasks, changes)
             
             # Guardar comprimido
             CacheOptimizer.set_compressed(main_cache_key, updated_tasks, timeout=300)
@@ -181,6 +162,12 @@ class TaskService:
                 
             return True
             
+        except DeltaLinkExpired:
+            # El próximo intento arranca una delta query nueva
+            logger.info(f"Delta link expirado para lista {list_id}, se reinicia")
+            cache.delete(delta_link_key)
+            return False
+            
         except Exception as e:
             logger.error(f"Error in incremental sync: {e}")
             return False
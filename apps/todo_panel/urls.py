@@ -20,6 +20,9 @@ urlpatterns = [
     path('api/tasks/<str:id_list>/sync/', views.start_sync_tasks, name='start_sync'),
     path('api/tasks/<str:id_list>/incremental/', views.incremental_sync, name='incremental_sync'),
     path('api/tasks/<str:id_list>/progress/', views.get_sync_progress, name='sync_progress'),
+    path('api/export/<str:id_list>/start/', views.start_export, name='start_export'),
+    path('api/export/status/<str:export_id>/', views.export_status, name='export_status'),
+    path('api/export/download/<str:export_id>/', views.download_export, name='download_export'),
     
     # Health Check
     path('health/', health.health_check, name='health_check'),
@@ -1,6 +1,9 @@
 from django.core.exceptions import ValidationError
 import re
 
+# Regex para UUID (8-4-4-4-12 caracteres hex), compilada una sola vez
+_UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+
 def validate_client_id(client_id: str):
     """
     Valida que el Client ID tenga el formato correcto (UUID).
@@ -8,10 +11,7 @@ def validate_client_id(client_id: str):
     if not client_id:
         raise ValidationError("Client ID no puede estar vacío.")
     
-    # Regex para UUID (8-4-4-4-12 caracteres hex)
-    uuid_pattern = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
-    
-    if not uuid_pattern.match(client_id):
+    if not _UUID_RE.match(client_id):
         raise ValidationError("Client ID debe ser un UUID válido (ej: 12345678-1234-1234-1234-123456789012).")
 
 def validate_device_code(device_code: str):
@@ -35,20 +35,22 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.conf import settings
-import hashlib
 import json
 import logging
 from functools import wraps
 from typing import Callable
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.urls import reverse
 
 from .models import MicrosoftUser
-from .services.encryption import encrypt_data, decrypt_data
-from .services.microsoft_auth import get_device_code, poll_for_token
+from .services.encryption import encrypt_many, hash_client_id
+from .services.microsoft_auth import RETRYABLE_POLL_ERRORS, get_device_code, poll_token_once
 from .services.microsoft_client import MicrosoftClient
 from .services.task_service import TaskService
 from .services.cache_optimizer import CacheOptimizer, RateLimiter
+from .services.attachment_storage import attachment_cache_key, load_attachment, touch_attachment
 import pandas as pd
 import re
 import zipfile
@@ -88,7 +90,7 @@ def profile_view(request):
     """Vista de la página de perfil del usuario."""
     user_id = request.session['user_id']
     try:
-        user = MicrosoftUser.objects.get(id=user_id)
+        user = MicrosoftUser.objects.for_request(user_id)
         client = MicrosoftClient(user)
         profile_data = client.get_profile()
 
@@ -219,15 +221,18 @@ def check_auth_status(request):
         logger.debug(f"Verificando estado de autenticación para client_id: {client_id[:8]}...")
         
         # Hacer UN intento de polling (no bloqueante)
-        response = poll_for_token(client_id, device_code)
+        response = poll_token_once(client_id, device_code)
         
         # Caso 1: Autorización pendiente
         if 'error' in response:
             error = response['error']
             error_description = response.get('error_description', error)
             
-            if error == 'authorization_pending':
+            # Pendiente o throttling: el device code sigue válido, se reintenta en el próximo poll
+            if error in RETRYABLE_POLL_ERRORS:
                 logger.debug("Autorización aún pendiente")
+                if response.get('retry_after') is not None:
+                    return JsonResponse({'status': 'pending', 'retry_after': response['retry_after']})
                 return JsonResponse({'status': 'pending'})
             
             # Caso 2: Errores específicos con mensajes amigables
@@ -276,25 +281,29 @@ def check_auth_status(request):
             }, status=500)
         
         # Hashear client_id para identificación (SHA-256)
-        client_id_hash = hashlib.sha256(client_id.encode()).hexdigest()
+        client_id_hash = hash_client_id(client_id)
         logger.debug(f"Client ID hash: {client_id_hash[:16]}...")
         
         # Buscar o crear usuario en base de datos
+        # Encriptar los tres valores con un único cipher
+        enc_client_id, enc_access_token, enc_refresh_token = encrypt_many(
+            [client_id, access_token, refresh_token]
+        )
         user, created = MicrosoftUser.objects.get_or_create(
             client_id_hash=client_id_hash,
             defaults={
-                'encrypted_client_id': encrypt_data(client_id),
-                'encrypted_access_token': encrypt_data(access_token),
-                'encrypted_refresh_token': encrypt_data(refresh_token) if refresh_token else b""
+                'encrypted_client_id': enc_client_id,
+                'encrypted_access_token': enc_access_token,
+                'encrypted_refresh_token': enc_refresh_token
             }
         )
         
         # Si el usuario ya existía, actualizar tokens
         if not created:
             logger.info(f"Usuario existente encontrado (ID: {user.id}), actualizando tokens")
-            user.encrypted_access_token = encrypt_data(access_token)
+            user.encrypted_access_token = enc_access_token
             if refresh_token:
-                user.encrypted_refresh_token = encrypt_data(refresh_token)
+                user.encrypted_refresh_token = enc_refresh_token
             user.save()
         else:
             logger.info(f"Nuevo usuario creado (ID: {user.id})")
@@ -337,7 +346,7 @@ def index(request):
     logger.info(f"Usuario {user_id} accediendo al panel de tareas")
     
     try:
-        user = MicrosoftUser.objects.get(id=user_id)
+        user = MicrosoftUser.objects.for_request(user_id)
         logger.debug(f"Usuario {user_id} encontrado en DB")
         
         client = MicrosoftClient(user)
@@ -366,12 +375,26 @@ def index(request):
         context = {'lists': [], 'error': 'Error al cargar las tareas'}
         return render(request, 'todo_panel/index.html', context)
 
+def _format_local_datetimes(values: List) -> List:
+    """
+    Convierte en bloque fechas ISO de Graph (UTC) a texto en hora de Buenos Aires.
+    
+    Un único pd.to_datetime sobre toda la columna reemplaza una conversión
+    escalar por tarea. Valores vacíos o inválidos se devuelven como None.
+    """
+    if not values:
+        return []
+    parsed = pd.to_datetime(pd.Series(values, dtype='object'), errors='coerce', utc=True, format='ISO8601')
+    formatted = parsed.dt.tz_convert('America/Argentina/Buenos_Aires').dt.strftime('%Y-%m-%d %H:%M:%S')
+    return [None if pd.isna(value) else value for value in formatted]
+
+
 @login_required
 def tarea(request, id_list):
     """Vista principal de tareas. Si no están en caché, muestra pantalla de carga."""
     user_id = request.session['user_id']
     try:
-        user = MicrosoftUser.objects.get(id=user_id)
+        user = MicrosoftUser.objects.for_request(user_id)
         
         # Verificar caché comprimido primero (ahorro ~60-70% memoria)
         cache_key = f"tasks_{user_id}_{id_list}"
@@ -391,30 +414,26 @@ def tarea(request, id_list):
 
         client = MicrosoftClient(user)
         
-        processed_tasks = {}
+        processed_tasks = []
         # Obtener nombre de la lista (intenta caché)
         list_name = client.get_tasks_list_name(id_list) or "Mis Tareas"
 
-        for tarea in tareas_raw:
-            fecha_limite = None
-            if tarea.get('dueDateTime'):
-                dt_str = tarea.get('dueDateTime').get('dateTime')
-                if dt_str:
-                    fecha_limite = pd.to_datetime(dt_str).tz_localize('UTC').tz_convert('America/Argentina/Buenos_Aires').strftime('%Y-%m-%d %H:%M:%S')
-
-            fecha_recordatorio = None
-            if tarea.get('reminderDateTime'):
-                dt_str = tarea.get('reminderDateTime').get('dateTime')
-                if dt_str:
-                    fecha_recordatorio = pd.to_datetime(dt_str).tz_localize('UTC').tz_convert('America/Argentina/Buenos_Aires').strftime('%Y-%m-%d %H:%M:%S')
+        # Convertir todas las fechas de una vez (vectorizado) en lugar de tarea por tarea
+        fechas_limite = _format_local_datetimes(
+            [(tarea.get('dueDateTime') or {}).get('dateTime') for tarea in tareas_raw]
+        )
+        fechas_recordatorio = _format_local_datetimes(
+            [(tarea.get('reminderDateTime') or {}).get('dateTime') for tarea in tareas_raw]
+        )
 
+        for tarea, fecha_limite, fecha_recordatorio in zip(tareas_raw, fechas_limite, fechas_recordatorio):
             # Procesar adjuntos (Metadatos solamente)
             attachments_list = []
             if tarea.get('hasAttachments') and tarea.get('attachments'):
                 for attachment in tarea['attachments']:
                     # No descargamos el contenido aquí (Lazy Loading)
                     # Generamos la clave de caché que se usaría
-                    attachment_key = f"microsoft_attachment:{id_list}:{tarea['id']}:{attachment['id']}"
+                    attachment_key = attachment_cache_key(id_list, tarea['id'], attachment['id'])
                     
                     attachment_info = {
                         'cache_key': attachment_key,
@@ -439,7 +458,7 @@ def tarea(request, id_list):
                 'hasAttachments': tarea.get('hasAttachments'),
                 'descripcion': tarea.get('body', {}).get('content', '')
             }
-            processed_tasks[tarea['id']] = estructura_tarea
+            processed_tasks.append(estructura_tarea)
 
         def sort_tasks_key(task):
             is_important = 1 if task.get('importancia') == 'high' else 0
@@ -449,10 +468,11 @@ def tarea(request, id_list):
             title = task.get('titulo', '')
             return (-is_important, -has_due_date, -has_attachments, -has_subtasks, title)
 
-        sorted_tasks = sorted(processed_tasks.values(), key=sort_tasks_key)
+        # Ordenar en el lugar: evita una segunda copia de la lista proyectada
+        processed_tasks.sort(key=sort_tasks_key)
 
         context = {
-            'tareas': sorted_tasks,
+            'tareas': processed_tasks,
             'list_name': list_name,
             'list_id': id_list, # Útil para refrescar
             'needs_bg_sync': str(needs_bg_sync).lower(),  # Pasar a JS
@@ -477,7 +497,7 @@ def incremental_sync(request, id_list):
         if cache.get(smart_sync_key):
              return JsonResponse({'status': 'skipped', 'message': 'Cooldown active'})
 
-        user = MicrosoftUser.objects.get(id=user_id)
+        user = MicrosoftUser.objects.for_request(user_id)
         service = TaskService(user)
         
         has_updates = service.sync_tasks_incremental(id_list)
@@ -492,12 +512,12 @@ def incremental_sync(request, id_list):
 
 @login_required
 def serve_attachment(request, cache_key):
-    """Sirve un archivo adjunto desde Redis, descargándolo si es necesario."""
+    """Sirve un archivo adjunto desde el storage, descargándolo si es necesario."""
     try:
         user_id = request.session['user_id']
         
-        # 1. Intentar obtener de Redis
-        file_content = cache.get(cache_key)
+        # 1. Intentar obtener del storage (la caché guarda solo la referencia)
+        file_content = load_attachment(cache_key)
         
         # 2. Si no está en caché, intentar descargarlo (Lazy Loading)
         if not file_content:
@@ -507,14 +527,14 @@ def serve_attachment(request, cache_key):
             if len(parts) >= 4 and parts[0] == 'microsoft_attachment':
                 try:
                     list_id, task_id, attachment_id = parts[1], parts[2], parts[3]
-                    user = MicrosoftUser.objects.get(id=user_id)
+                    user = MicrosoftUser.objects.for_request(user_id)
                     client = MicrosoftClient(user)
                     
                     # save_attachment descarga, cachea y retorna la clave
                     # Nota: save_attachment internally actually calls get_attachment and sets cache
                     # We can use it directly.
                     client.save_attachment(list_id, task_id, attachment_id)
-                    file_content = cache.get(cache_key)
+                    file_content = load_attachment(cache_key)
                 except Exception as e:
                     logger.error(f"Error recuperando adjunto {cache_key}: {e}")
             
@@ -552,7 +572,7 @@ def serve_attachment(request, cache_key):
         response = HttpResponse(file_content, content_type=content_type)
         
         # Refrescar el tiempo de expiración en caché (otros 5 minutos)
-        cache.set(cache_key, file_content, timeout=300)
+        touch_attachment(cache_key)
         
         return response
         
@@ -647,7 +667,7 @@ def export_tasks(request, id_list):
         return HttpResponse('Formato inválido. Use "json" o "markdown"', status=400)
     
     try:
-        user = MicrosoftUser.objects.get(id=user_id)
+        user = MicrosoftUser.objects.for_request(user_id)
         client = MicrosoftClient(user)
         
         # Obtener nombre de lista
@@ -658,12 +678,12 @@ def export_tasks(request, id_list):
         
         # Usar servicio de exportación con controles de seguridad
         export_service = ExportService(user_id, client)
-        zip_content, zip_filename = export_service.create_export(
+        zip_chunks, zip_filename = export_service.stream_export(
             id_list, list_name, export_format
         )
         
-        # Retornar respuesta
-        response = HttpResponse(zip_content, content_type='application/zip')
+        # Retornar respuesta en streaming (el ZIP no se arma entero en memoria)
+        response = StreamingHttpResponse(zip_chunks, content_type='application/zip')
         response['Content-Disposition'] = f'attachment; filename="{zip_filename}"'
         
         return response
@@ -703,7 +723,7 @@ def start_sync_tasks(request, id_list):
         }, status=429)
     
     try:
-        user = MicrosoftUser.objects.get(id=user_id)
+        user = MicrosoftUser.objects.for_refresh(user_id)
         service = TaskService(user)
         service.sync_tasks_background(id_list)
         return JsonResponse({'status': 'started'})
@@ -716,9 +736,105 @@ def get_sync_progress(request, id_list):
     """Obtiene el progreso de la sincronización."""
     user_id = request.session['user_id']
     try:
-        user = MicrosoftUser.objects.get(id=user_id)
+        user = MicrosoftUser.objects.for_request(user_id)
         service = TaskService(user)
         progress = service.get_sync_progress(id_list)
         return JsonResponse(progress if progress else {'status': 'unknown'})
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
+@login_required
+@require_http_methods(["POST"])
+def start_export(request, id_list):
+    """
+    Inicia la exportación de una lista en segundo plano.
+    El cliente consulta export_status hasta obtener la URL de descarga.
+    """
+    from .services.export_service import ExportService, ExportLimitExceeded
+    
+    user_id = request.session['user_id']
+    export_format = request.GET.get('format', 'json').lower()
+    
+    if export_format not in ['json', 'markdown']:
+        return JsonResponse({'status': 'error', 'message': 'Formato inválido. Use "json" o "markdown"'}, status=400)
+    
+    try:
+        user = MicrosoftUser.objects.for_request(user_id)
+        client = MicrosoftClient(user)
+        
+        list_name = client.get_tasks_list_name(id_list)
+        if not list_name:
+            logger.warning(f"Lista {id_list} no encontrada para usuario {user_id}")
+            return JsonResponse({'status': 'error', 'message': 'Lista no encontrada'}, status=404)
+        
+        export_id = ExportService(user_id, client).export_background(id_list, list_name, export_format)
+        return JsonResponse({'status': 'started', 'export_id': export_id})
+        
+    except ExportLimitExceeded as e:
+        logger.warning(f"Rate limit excedido para usuario {user_id}: {str(e)}")
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=429)
+        
+    except ObjectDoesNotExist:
+        logger.error(f"Usuario {user_id} no encontrado")
+        return JsonResponse({'status': 'error', 'message': 'Usuario no encontrado'}, status=404)
+        
+    except Exception as e:
+        logger.error(f"Error iniciando exportación: {str(e)}", exc_info=True)
+        return JsonResponse({'status': 'error', 'message': 'Error al iniciar la exportación'}, status=500)
+
+
+@login_required
+def export_status(request, export_id):
+    """Obtiene el estado de una exportación en segundo plano."""
+    from .services.export_service import ExportService
+    
+    user_id = request.session['user_id']
+    status = ExportService.get_export_status(user_id, export_id)
+    if not status:
+        return JsonResponse({'state': 'unknown'}, status=404)
+    
+    response = {'state': status['state']}
+    if status['state'] == 'done':
+        response['download_url'] = reverse('todo_panel:download_export', args=[export_id])
+        response['filename'] = status['filename']
+    elif status['state'] == 'error':
+        response['message'] = status['message']
+    return JsonResponse(response)
+
+
+class _DiscardOnCloseFileResponse(FileResponse):
+    """FileResponse que ejecuta on_close una vez enviado (o cortado) el archivo."""
+    
+    def __init__(self, *args, on_close, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_close = on_close
+    
+    def close(self):
+        super().close()
+        self._on_close()
+
+
+@login_required
+def download_export(request, export_id):
+    """
+    Descarga el ZIP generado por una exportación en segundo plano.
+    Es de un solo uso: al terminar la respuesta se borran el ZIP y su estado.
+    """
+    from .services.export_service import ExportService
+    
+    user_id = request.session['user_id']
+    status = ExportService.get_export_status(user_id, export_id)
+    if not status or status.get('state') != 'done':
+        return HttpResponse('Exportación no encontrada o expirada', status=404)
+    
+    try:
+        return _DiscardOnCloseFileResponse(
+            default_storage.open(status['path'], 'rb'),
+            as_attachment=True,
+            filename=status['filename'],
+            on_close=lambda: ExportService.discard_export(user_id, export_id, status['path']),
+        )
+    except FileNotFoundError:
+        logger.warning(f"Archivo de exportación {export_id} no encontrado en storage")
+        return HttpResponse('Exportación no encontrada o expirada', status=404)
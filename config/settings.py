@@ -82,6 +82,11 @@ if DB_ENGINE == 'django.db.backends.postgresql':
             'PASSWORD': env('DB_PASSWORD'),
             'HOST': env('DB_HOST'),
             'PORT': env('DB_PORT', default='5432'),
+            # Conexiones persistentes: evita handshake TCP+auth por request
+            'CONN_MAX_AGE': env.int('DB_CONN_MAX_AGE', default=60),
+            'CONN_HEALTH_CHECKS': True,
+            # Requerido si DB_HOST apunta a PgBouncer en pool_mode=transaction
+            'DISABLE_SERVER_SIDE_CURSORS': env.bool('DB_PGBOUNCER_TRANSACTION_POOLING', default=False),
         }
     }
 else:
@@ -113,6 +118,9 @@ CACHES = {
     }
 }
 
+# Diccionario zstd entrenado para CacheOptimizer (opcional)
+CACHE_ZSTD_DICT_PATH = env('CACHE_ZSTD_DICT_PATH', default=None)
+
 # User Model
 AUTH_USER_MODEL = 'core.User'
 
@@ -146,6 +154,9 @@ STATICFILES_DIRS = [
 ]
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# Media (ZIPs de exportaciones en segundo plano; no se sirven públicamente)
+MEDIA_ROOT = env('MEDIA_ROOT', default=BASE_DIR / 'media')
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -181,7 +192,14 @@ LOGGING = {
 # Microsoft OAuth Settings
 MICROSOFT_TENANT_ID = env('TENANT_ID', default='consumers')
 ENCRYPTION_SALT = env('ENCRYPTION_SALT', default='default-salt-change-me')
+# Conexiones keep-alive a graph.microsoft.com que conserva cada worker
+# (debe cubrir los hilos simultáneos: requests + $batch en paralelo)
+GRAPH_HTTP_POOL_MAXSIZE = env.int('GRAPH_HTTP_POOL_MAXSIZE', default=50)
 
 # Rate Limiting
 RATE_LIMIT_SYNC_TASKS = env.int('RATE_LIMIT_SYNC_TASKS', default=10)  # requests per minute
 RATE_LIMIT_WINDOW = env.int('RATE_LIMIT_WINDOW', default=60)  # seconds
+
+# Exportación (nivel zlib del ZIP: 1 = más rápido, 9 = más compresión)
+EXPORT_ZIP_COMPRESSLEVEL = env.int('EXPORT_ZIP_COMPRESSLEVEL', default=1)
+EXPORT_ZIP_TEXT_COMPRESSLEVEL = env.int('EXPORT_ZIP_TEXT_COMPRESSLEVEL', default=3)